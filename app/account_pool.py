@@ -0,0 +1,110 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.schema import TaskCacheData
+from app.user_client import DiscordUserClient
+
+
+class NoAvailableAccountError(Exception):
+    pass
+
+
+class DiscordUserClientPool:
+    """
+    One gateway connection per configured account. New jobs go to the account with the fewest
+    in-flight jobs; follow-ups (upscale / vary) go back to the account that owns the source message.
+
+    With ``max_in_flight`` a job waits until its account has fewer jobs submitted or running than that,
+    so jobs beyond what the accounts can run stay in the action queue.
+    """
+
+    def __init__(self):
+        self.clients: List[DiscordUserClient] = []
+        self.__start_tasks: Dict[DiscordUserClient, asyncio.Task] = {}
+        # replaced and set whenever an account finishes or gives up a job
+        self.__slot_freed = asyncio.Event()
+
+    def add(self, client: DiscordUserClient):
+        self.clients.append(client)
+        client.on_slot_freed = self.__notify_slot_freed
+
+    def __notify_slot_freed(self):
+        slot_freed, self.__slot_freed = self.__slot_freed, asyncio.Event()
+        slot_freed.set()
+
+    @staticmethod
+    def __has_slot(client: DiscordUserClient, max_in_flight: Optional[int]) -> bool:
+        return not max_in_flight or client.in_flight_count < max_in_flight
+
+    async def wait_for_slot(self, max_in_flight: Optional[int] = None):
+        """Wait until any account has fewer than ``max_in_flight`` jobs."""
+        while True:
+            slot_freed = self.__slot_freed
+            if not self.clients or any(self.__has_slot(client, max_in_flight) for client in self.clients):
+                return
+            await slot_freed.wait()
+
+    async def start(self, client: DiscordUserClient, token: str):
+        self.add(client)
+        await client.login(token)
+        self.__start_tasks[client] = asyncio.create_task(client.connect(reconnect=True))
+
+    async def wait_until_ready(self):
+        await asyncio.gather(*[client.wait_until_ready() for client in self.clients])
+
+    async def close(self):
+        for task in self.__start_tasks.values():
+            task.cancel()
+        for client in self.clients:
+            if not client.is_closed():
+                await client.close()
+
+    def get_by_account_id(self, account_id: str) -> Optional[DiscordUserClient]:
+        for client in self.clients:
+            if client.account_id == account_id:
+                return client
+        return None
+
+    def get_for_task(self, data: TaskCacheData) -> Optional[DiscordUserClient]:
+        if data.account_id:
+            return self.get_by_account_id(data.account_id)
+        # records written before accounts were tracked, only the channel is known
+        for client in self.clients:
+            if str(client.channel_id) == data.channel_id:
+                return client
+        return None
+
+    def least_loaded(self) -> DiscordUserClient:
+        candidates = [client for client in self.clients if client.is_ready()] or self.clients
+        if not candidates:
+            raise NoAvailableAccountError()
+        return min(candidates, key=lambda x: x.in_flight_count)
+
+    async def __acquire(self, owner: Optional[TaskCacheData], max_in_flight: Optional[int]) -> DiscordUserClient:
+        while True:
+            slot_freed = self.__slot_freed
+            if owner is not None:
+                client = self.get_for_task(owner)
+                if client is None:
+                    raise NoAvailableAccountError()
+            else:
+                client = self.least_loaded()
+            if self.__has_slot(client, max_in_flight):
+                return client
+            await slot_freed.wait()
+
+    @asynccontextmanager
+    async def dispatch(
+            self,
+            owner: Optional[TaskCacheData] = None,
+            max_in_flight: Optional[int] = None
+    ) -> AsyncIterator[DiscordUserClient]:
+        client = await self.__acquire(owner=owner, max_in_flight=max_in_flight)
+        client.pending_submissions += 1
+        try:
+            yield client
+        finally:
+            client.pending_submissions -= 1
+            # a job bound to a message keeps its slot in in_flight_tasks until it finishes
+            self.__notify_slot_freed()
@@ -0,0 +1,502 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import io
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import uuid
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import discord
+import msgpack
+from pydantic import BaseModel
+from redis.asyncio import Redis
+
+from app.account_pool import DiscordUserClientPool
+from app.cache import Cache
+from app.event_callback import EventCallback
+from app.metrics import observe_stage, submit_labels
+from app.models import GenModel, MoveModel, VideoModel
+from app.schema import TaskCommand, TaskCacheData, TaskStatus, Mode, AnimateIntensity, AnimateLength, \
+    VideoReferMode, VideoLength, VideoKey
+from app.result_parser import parse_error
+from app.task_failure import fail_task
+from app.user_client import DiscordUserClient
+
+
+class ActionType(enum.Enum):
+    GEN = "GEN"
+    REAL = "REAL"
+    ANIMATE = "ANIMATE"
+    VIDEO = "VIDEO"
+    MOVE = "MOVE"
+    UPSCALE = "UPSCALE"
+    VARY = "VARY"
+
+
+class GenActionParams(BaseModel):
+    prompt: str
+    mode: Optional[Mode] = None
+    model: Optional[GenModel] = None
+
+
+class RealActionParams(BaseModel):
+    prompt: Optional[str] = None
+    mode: Optional[Mode] = None
+
+
+class AnimateActionParams(BaseModel):
+    length: AnimateLength
+    intensity: AnimateIntensity
+    prompt: Optional[str] = None
+    mode: Optional[Mode] = None
+
+
+class VideoActionParams(BaseModel):
+    prompt: str
+    model: VideoModel
+    refer_mode: VideoReferMode
+    length: VideoLength
+    mode: Optional[Mode] = None
+    video_key: Optional[VideoKey] = None
+    subject_only: Optional[bool] = None
+    lip_sync: Optional[bool] = None
+
+
+class MoveActionParams(BaseModel):
+    prompt: str
+    model: MoveModel
+    length: VideoLength
+    mode: Optional[Mode] = None
+    video_key: Optional[VideoKey] = None
+
+
+class ButtonActionParams(BaseModel):
+    custom_id: str
+    message_id: str
+
+
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+class QueuedFile(BaseModel):
+    filename: Optional[str] = None
+    # spooled copy of the upload, removed once the action is processed
+    path: str
+
+    @staticmethod
+    def spool(fp: BinaryIO, filename: Optional[str] = None, spool_dir: Optional[str] = None) -> QueuedFile:
+        """Copy ``fp`` to a temporary file chunk by chunk, blocking, run it in a thread."""
+        with tempfile.NamedTemporaryFile(dir=spool_dir, prefix='domoai-upload-', delete=False) as f:
+            shutil.copyfileobj(fp, f, SPOOL_CHUNK_SIZE)
+        return QueuedFile(filename=filename, path=f.name)
+
+    def to_discord_file(self) -> discord.File:
+        return discord.File(self.path, filename=self.filename)
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class QueuedAction(BaseModel):
+    task_id: str
+    type: ActionType
+    command: TaskCommand
+    params: Dict
+    files: Dict[str, QueuedFile] = {}
+    # the task whose message is being acted on, follow-ups must run on the account that owns it
+    source_task: Optional[TaskCacheData] = None
+    enqueued_at: float
+    mode: Optional[Mode] = None
+
+    def discard_files(self):
+        for file in self.files.values():
+            file.discard()
+
+
+class ActionQueueFullError(Exception):
+    pass
+
+
+class ActionQueue:
+
+    async def put(self, action: QueuedAction):
+        pass
+
+    async def get(self) -> QueuedAction:
+        pass
+
+    async def qsize(self) -> int:
+        return 0
+
+    async def ack(self, action: QueuedAction):
+        """Mark an action returned by ``get`` as processed."""
+        pass
+
+    async def recover(self) -> int:
+        """Put actions which were taken but never acknowledged back in the queue."""
+        return 0
+
+
+class MemoryActionQueue(ActionQueue):
+    def __init__(self, max_size: int = 0):
+        self.queue: asyncio.Queue[QueuedAction] = asyncio.Queue(maxsize=max_size)
+
+    async def put(self, action: QueuedAction):
+        try:
+            self.queue.put_nowait(action)
+        except asyncio.QueueFull as e:
+            raise ActionQueueFullError() from e
+
+    async def get(self) -> QueuedAction:
+        return await self.queue.get()
+
+    async def qsize(self) -> int:
+        return self.queue.qsize()
+
+
+class RedisActionQueue(ActionQueue):
+    """
+    Action queue in a Redis list, shared between the API workers which enqueue actions and the gateway
+    which drains them. Each entry is one msgpack record holding the action and its uploaded files, the
+    spooled files move into the record on put and back to ``spool_dir`` on get.
+
+    ``get`` moves the record into a processing list of this gateway, where it stays until ``ack``. A
+    gateway which crashes or steps down leaves its records there, and ``recover`` on the next gateway start
+    moves the records of every gateway back to the head of the queue, so only one gateway may drain the
+    queue at a time (role gateway once, or leader election). Records which can't be decoded are moved
+    aside to a dead letter list instead of being handed out (and recovered) again and again.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = '', max_size: int = 0, spool_dir: Optional[str] = None):
+        self.redis = redis
+        self.key = f"{prefix}action_queue"
+        self.processing_key = f"{prefix}action_queue:processing:{uuid.uuid4().hex}"
+        # processing lists of all gateways ever started, for recover
+        self.processing_keys_key = f"{prefix}action_queue:processing"
+        self.dead_letter_key = f"{prefix}action_queue:dead"
+        self.max_size = max_size
+        self.spool_dir = spool_dir
+        # task id -> record of the actions taken and not acknowledged yet
+        self.__receipts: Dict[str, bytes] = {}
+
+    async def put(self, action: QueuedAction):
+        # the check is not atomic with the push, max_size is a soft bound
+        if self.max_size and await self.redis.llen(self.key) >= self.max_size:
+            raise ActionQueueFullError()
+        record = {
+            'action': action.model_dump(mode='json', exclude={'files'}),
+            'files': {
+                name: [file.filename, await asyncio.to_thread(file.read_bytes)] for name, file in action.files.items()
+            },
+        }
+        await self.redis.lpush(self.key, msgpack.packb(record, use_bin_type=True))
+        action.discard_files()
+
+    async def get(self) -> QueuedAction:
+        await self.redis.sadd(self.processing_keys_key, self.processing_key)
+        while True:
+            value = await self.redis.blmove(self.key, self.processing_key, 0, src='RIGHT', dest='LEFT')
+            try:
+                record = msgpack.unpackb(value, raw=False)
+                action = QueuedAction.model_validate(record['action'])
+                files = [(name, filename, data) for name, (filename, data) in record['files'].items()]
+            except Exception as e:
+                print(f"unreadable action queue record, moved to {self.dead_letter_key}: {e!r}")
+                await self.__set_aside(value)
+                continue
+            break
+        action.files = {}
+        try:
+            for name, filename, data in files:
+                action.files[name] = await asyncio.to_thread(
+                    QueuedFile.spool,
+                    io.BytesIO(data),
+                    filename,
+                    self.spool_dir
+                )
+        except BaseException:
+            # stays in the processing list, recovered by the next gateway start
+            action.discard_files()
+            raise
+        self.__receipts[action.task_id] = value
+        return action
+
+    async def __set_aside(self, value: bytes):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.processing_key, 1, value)
+            pipe.lpush(self.dead_letter_key, value)
+            await pipe.execute()
+
+    async def ack(self, action: QueuedAction):
+        value = self.__receipts.pop(action.task_id, None)
+        if value is not None:
+            await self.redis.lrem(self.processing_key, 1, value)
+
+    async def recover(self) -> int:
+        recovered = 0
+        for key in await self.redis.smembers(self.processing_keys_key):
+            # back to the head of the queue (BLMOVE takes from the right), the oldest ends up first
+            while await self.redis.lmove(key, self.key, src='LEFT', dest='RIGHT') is not None:
+                recovered += 1
+            if key.decode() != self.processing_key:
+                await self.redis.srem(self.processing_keys_key, key)
+        return recovered
+
+    async def qsize(self) -> int:
+        return await self.redis.llen(self.key)
+
+
+class ActionSubmitError(Exception):
+    pass
+
+
+# seconds between attempts to take the next action after the queue failed, doubling up to the max
+GET_RETRY_MIN_INTERVAL = 1
+GET_RETRY_MAX_INTERVAL = 30
+
+
+class ActionQueueWorker:
+    """
+    Drains the action queue: dispatches each action to an account, sends the slash command or
+    button click and binds the reply message, moving the task QUEUED -> SUBMITTED -> RUNNING,
+    or FAILED if any of it goes wrong.
+
+    An account runs at most ``max_concurrent_per_account`` tasks at a time, submitting or running on
+    DomoAI. Actions are only taken from the queue while some account has room for one more.
+    """
+
+    def __init__(
+            self,
+            queue: ActionQueue,
+            pool: DiscordUserClientPool,
+            cache: Cache,
+            event_callback: EventCallback,
+            max_concurrent_per_account: int,
+            ready_timeout: float = 120
+    ):
+        self.queue = queue
+        self.pool = pool
+        self.cache = cache
+        self.event_callback = event_callback
+        self.max_concurrent_per_account = max_concurrent_per_account
+        # seconds to wait for the dispatched account to connect and load its commands
+        self.ready_timeout = ready_timeout
+        self.__tasks: List[asyncio.Task] = []
+
+    def start(self):
+        worker_count = max(1, len(self.pool.clients)) * self.max_concurrent_per_account
+        for _ in range(worker_count):
+            self.__tasks.append(asyncio.create_task(self.__run()))
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks.clear()
+
+    async def __run(self):
+        retry_interval = GET_RETRY_MIN_INTERVAL
+        while True:
+            try:
+                # leave the actions in the queue while every account is busy
+                await self.pool.wait_for_slot(max_in_flight=self.max_concurrent_per_account)
+                action = await self.queue.get()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # e.g. redis unreachable, keep draining once it is back
+                traceback.print_exc()
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, GET_RETRY_MAX_INTERVAL)
+                continue
+            retry_interval = GET_RETRY_MIN_INTERVAL
+            try:
+                await self.process(action)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                await self.__set_failed(action, error=str(e) or e.__class__.__name__)
+            finally:
+                action.discard_files()
+            # not reached when cancelled, the action is recovered by the next gateway start
+            try:
+                await self.queue.ack(action)
+            except Exception:
+                traceback.print_exc()
+
+    async def process(self, action: QueuedAction):
+        submit_labels.set((action.command, action.mode))
+        async with self.pool.dispatch(
+                owner=action.source_task,
+                max_in_flight=self.max_concurrent_per_account
+        ) as client:
+            try:
+                await asyncio.wait_for(client.wait_until_ready(), timeout=self.ready_timeout)
+            except asyncio.TimeoutError as e:
+                raise ActionSubmitError(f"account not ready after {self.ready_timeout}s") from e
+            observe_stage('queue_wait', time.time() - action.enqueued_at, command=action.command, mode=action.mode)
+            # the watchdog may have timed the task out while it was queued, the client has been told, and
+            # an action recovered from a stopped gateway may have been submitted before it stopped
+            data = await self.cache.get_task_data_by_id(task_id=action.task_id)
+            if data is not None and data.status != TaskStatus.QUEUED:
+                print(f"{action.type.value.lower()}, task_id: {action.task_id} is {data.status.value}, skipped")
+                return
+            interaction, keyword = await self.__submit(client, action)
+            print(f"{action.type.value.lower()}, task_id: {action.task_id}, "
+                  f"interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
+            submitted_at = time.time()
+            if await self.__is_finished(action):
+                return
+            await self.cache.set_task_id2data(task_id=action.task_id, data=TaskCacheData(
+                command=action.command,
+                status=TaskStatus.SUBMITTED,
+                channel_id=str(client.channel_id),
+                guild_id=str(client.guild_id),
+                account_id=client.account_id,
+                created_at=action.enqueued_at,
+                submitted_at=submitted_at,
+                mode=action.mode
+            ))
+
+            try:
+                message = await client.wait_for_generating_message(
+                    interaction=interaction,
+                    embeds_desc_keyword=keyword
+                )
+            except asyncio.TimeoutError as e:
+                raise ActionSubmitError(f"no reply to interaction {interaction.id}") from e
+            observe_stage(
+                'generating_message',
+                time.time() - submitted_at,
+                command=action.command,
+                mode=action.mode
+            )
+            # the reply to the interaction is bound whatever it says, DomoAI may have rejected the job
+            error = parse_error(message)
+            if error is not None:
+                raise ActionSubmitError(error)
+            if await self.__is_finished(action):
+                return
+            data = TaskCacheData(
+                command=action.command,
+                status=TaskStatus.RUNNING,
+                channel_id=str(client.channel_id),
+                guild_id=str(client.guild_id),
+                message_id=str(message.id),
+                account_id=client.account_id,
+                created_at=action.enqueued_at,
+                submitted_at=submitted_at,
+                mode=action.mode
+            )
+            client.bind_task(message_id=str(message.id), task_id=action.task_id, data=data)
+            await self.cache.set_task(task_id=action.task_id, data=data)
+
+    async def __is_finished(self, action: QueuedAction) -> bool:
+        data = await self.cache.get_task_data_by_id(task_id=action.task_id)
+        if data is None or not data.status.is_finished:
+            return False
+        print(f"{action.type.value.lower()}, task_id: {action.task_id} is {data.status.value} already, skipped")
+        return True
+
+    @staticmethod
+    async def __submit(client: DiscordUserClient, action: QueuedAction) -> Tuple[discord.Interaction, str]:
+        files = {name: file.to_discord_file() for name, file in action.files.items()}
+        keyword = 'Waiting to start'
+        if action.type == ActionType.GEN:
+            params = GenActionParams.model_validate(action.params)
+            interaction = await client.gen(
+                prompt=params.prompt,
+                image=files.get('image'),
+                mode=params.mode,
+                model=params.model
+            )
+        elif action.type == ActionType.REAL:
+            params = RealActionParams.model_validate(action.params)
+            interaction = await client.real(prompt=params.prompt, image=files['image'], mode=params.mode)
+        elif action.type == ActionType.ANIMATE:
+            params = AnimateActionParams.model_validate(action.params)
+            interaction = await client.animate(
+                prompt=params.prompt,
+                image=files['image'],
+                length=params.length,
+                intensity=params.intensity,
+                mode=params.mode
+            )
+        elif action.type == ActionType.VIDEO:
+            params = VideoActionParams.model_validate(action.params)
+            interaction = await client.video(
+                prompt=params.prompt,
+                video=files['video'],
+                image=files.get('image'),
+                model=params.model,
+                refer_mode=params.refer_mode,
+                length=params.length,
+                mode=params.mode,
+                video_key=params.video_key,
+                subject_only=params.subject_only,
+                lip_sync=params.lip_sync,
+            )
+            keyword = 'Generating'
+        elif action.type == ActionType.MOVE:
+            params = MoveActionParams.model_validate(action.params)
+            interaction = await client.move(
+                prompt=params.prompt,
+                image=files['image'],
+                video=files['video'],
+                model=params.model,
+                length=params.length,
+                mode=params.mode,
+                video_key=params.video_key,
+            )
+            keyword = 'Generating'
+        else:
+            params = ButtonActionParams.model_validate(action.params)
+            interaction = await client.click_button(custom_id=params.custom_id, message_id=int(params.message_id))
+
+        if interaction is None:
+            raise ActionSubmitError(f"command for {action.type.value} is not available")
+        if not interaction.successful:
+            raise ActionSubmitError(f"interaction {interaction.id} was not successful")
+        return interaction, keyword
+
+    async def __set_failed(self, action: QueuedAction, error: str):
+        await fail_task(
+            cache=self.cache,
+            event_callback=self.event_callback,
+            task_id=action.task_id,
+            error=error,
+            command=action.command
+        )
+
+
+def new_action(
+        task_id: str,
+        action_type: ActionType,
+        command: TaskCommand,
+        params: BaseModel,
+        files: Optional[Dict[str, QueuedFile]] = None,
+        source_task: Optional[TaskCacheData] = None
+) -> QueuedAction:
+    return QueuedAction(
+        task_id=task_id,
+        type=action_type,
+        command=command,
+        params=params.model_dump(mode='json'),
+        files=files or {},
+        source_task=source_task,
+        enqueued_at=time.time(),
+        mode=getattr(params, 'mode', None)
+    )
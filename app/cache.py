@@ -1,15 +1,188 @@
 from __future__ import annotations
 
-from typing import Any, Optional
+import asyncio
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+import msgpack
+from pydantic import BaseModel
 from redis.asyncio import Redis, from_url
 
-from app.schema import TaskCacheData
+from app.schema import TaskCacheData, TaskCommand, TaskStatus
+
+
+TaskListener = Callable[[str, TaskCacheData], None]
+
+
+class TaskDataCodec:
+    """
+    Serializes TaskCacheData for storage. ``decode`` of every codec reads all known formats, so
+    switching codecs never strands records written by the previous one.
+    """
+
+    def encode(self, data: TaskCacheData) -> Union[str, bytes]:
+        raise NotImplementedError()
+
+    def decode(self, value: Union[str, bytes]) -> TaskCacheData:
+        if isinstance(value, bytes) and value.startswith(MsgpackTaskDataCodec.MAGIC):
+            return MsgpackTaskDataCodec.decode_record(value)
+        return TaskCacheData.model_validate_json(value)
+
+
+class JsonTaskDataCodec(TaskDataCodec):
+
+    def encode(self, data: TaskCacheData) -> Union[str, bytes]:
+        return data.model_dump_json()
+
+
+class MsgpackTaskDataCodec(TaskDataCodec):
+    """
+    msgpack with short field tags and integer enums, prefixed with a magic byte and a version.
+
+    Tags and enum numbers are part of the stored format: only ever append to these tables.
+    """
+
+    # 0xc1 is never used by msgpack and can't start a JSON document
+    MAGIC = b'\xc1'
+    VERSION = 1
+
+    FIELD_TAGS = {
+        'command': 'c',
+        'channel_id': 'ch',
+        'guild_id': 'g',
+        'message_id': 'm',
+        'images': 'i',
+        'videos': 'v',
+        'status': 's',
+        'upscale_custom_ids': 'u',
+        'vary_custom_ids': 'va',
+        'account_id': 'a',
+        'error': 'e',
+        'progress_percent': 'pp',
+        'queue_position': 'q',
+        'started_at': 'sa',
+        'created_at': 'ca',
+        'submitted_at': 'sb',
+        'mode': 'mo',
+    }
+    ASSET_FIELD_TAGS = {
+        'size': 's',
+        'width': 'w',
+        'height': 'h',
+        'url': 'u',
+        'proxy_url': 'p',
+        'content_type': 't',
+    }
+    COMMAND_TAGS = {
+        TaskCommand.GEN: 0,
+        TaskCommand.REAL: 1,
+        TaskCommand.MOVE: 2,
+        TaskCommand.VIDEO: 3,
+        TaskCommand.ANIMATE: 4,
+    }
+    STATUS_TAGS = {
+        TaskStatus.QUEUED: 0,
+        TaskStatus.SUBMITTED: 1,
+        TaskStatus.RUNNING: 2,
+        TaskStatus.SUCCESS: 3,
+        TaskStatus.FAILED: 4,
+        TaskStatus.TIMEOUT: 5,
+    }
+    # snowflakes are stored as integers
+    ID_FIELDS = {'channel_id', 'guild_id', 'message_id', 'account_id'}
+
+    FIELD_NAMES = {v: k for k, v in FIELD_TAGS.items()}
+    ASSET_FIELD_NAMES = {v: k for k, v in ASSET_FIELD_TAGS.items()}
+    COMMANDS = {v: k for k, v in COMMAND_TAGS.items()}
+    STATUSES = {v: k for k, v in STATUS_TAGS.items()}
+
+    @staticmethod
+    def __proxy_url(url: str) -> str:
+        return url.replace('https://cdn.discordapp.com/', 'https://media.discordapp.net/', 1)
+
+    @classmethod
+    def __encode_asset(cls, asset: dict) -> dict:
+        # the proxy url is usually derived from the url, only keep it when it is not
+        if asset.get('proxy_url') == cls.__proxy_url(asset['url']):
+            del asset['proxy_url']
+        return {cls.ASSET_FIELD_TAGS[name]: value for name, value in asset.items()}
+
+    @classmethod
+    def __decode_asset(cls, record: dict) -> dict:
+        values = {cls.ASSET_FIELD_NAMES[tag]: value for tag, value in record.items()}
+        values.setdefault('proxy_url', cls.__proxy_url(values['url']))
+        return values
+
+    def encode(self, data: TaskCacheData) -> Union[str, bytes]:
+        record = {}
+        for name, value in data.model_dump(exclude_none=True).items():
+            if name == 'command':
+                value = self.COMMAND_TAGS[value]
+            elif name == 'status':
+                value = self.STATUS_TAGS[value]
+            elif name == 'mode':
+                value = value.value
+            elif name in ('images', 'videos'):
+                value = [self.__encode_asset(x) for x in value]
+            elif name in self.ID_FIELDS and value.isdigit():
+                value = int(value)
+            record[self.FIELD_TAGS[name]] = value
+        return self.MAGIC + bytes([self.VERSION]) + msgpack.packb(record, use_bin_type=True)
+
+    @classmethod
+    def decode_record(cls, value: bytes) -> TaskCacheData:
+        version = value[len(cls.MAGIC)]
+        if version != cls.VERSION:
+            raise ValueError(f'unsupported task data version: {version}')
+        record = msgpack.unpackb(value[len(cls.MAGIC) + 1:], raw=False)
+        values = {}
+        for tag, item in record.items():
+            name = cls.FIELD_NAMES[tag]
+            if name == 'command':
+                item = cls.COMMANDS[item]
+            elif name == 'status':
+                item = cls.STATUSES[item]
+            elif name in ('images', 'videos'):
+                item = [cls.__decode_asset(x) for x in item]
+            elif name in cls.ID_FIELDS:
+                item = str(item)
+            values[name] = item
+        return TaskCacheData.model_validate(values)
+
+
+def get_task_data_codec(name: str) -> TaskDataCodec:
+    if name == 'msgpack':
+        return MsgpackTaskDataCodec()
+    if name == 'json':
+        return JsonTaskDataCodec()
+    raise ValueError(f'unknown task data codec: {name}')
+
+
+class KeyFamilyStats(BaseModel):
+    keys: int = 0
+    bytes: int = 0
 
 
 class Cache:
-    def __init__(self, prefix: str = ''):
+    def __init__(
+            self,
+            prefix: str = '',
+            running_ttl: Optional[int] = None,
+            finished_ttl: Optional[int] = None,
+            codec: Optional[TaskDataCodec] = None
+    ):
         self.prefix = prefix
+        self.codec = codec or JsonTaskDataCodec()
+        # retention of task records in seconds, None keeps them forever
+        self.running_ttl = running_ttl or None
+        self.finished_ttl = finished_ttl or None
+        self.task_listeners: List[TaskListener] = []
+
+    def add_task_listener(self, listener: TaskListener):
+        self.task_listeners.append(listener)
 
     async def set_value(self, key: str, value: Any, ex: Optional[int] = None):
         pass
@@ -17,9 +190,49 @@ class Cache:
     async def get_value(self, key: str):
         pass
 
+    async def get_value_ex(self, key: str, ex: Optional[int] = None):
+        """Get a value and reset its expiry to ``ex``."""
+        return await self.get_value(key=key)
+
+    async def expire_value(self, key: str, ex: int):
+        """Reset the expiry of an existing key to ``ex`` seconds."""
+        pass
+
+    async def delete_value(self, key: str):
+        pass
+
+    async def add_set_members(self, key: str, *members: str):
+        pass
+
+    async def remove_set_members(self, key: str, *members: str):
+        pass
+
+    async def get_set_members(self, key: str) -> List[str]:
+        return []
+
+    async def mget(self, keys: List[str]) -> List[Any]:
+        return [await self.get_value(key) for key in keys]
+
+    async def mset(self, values: Dict[str, Any], ex: Optional[int] = None):
+        """Set several keys at once, atomically where the backend supports it."""
+        for key, value in values.items():
+            await self.set_value(key=key, value=value, ex=ex)
+
     async def close(self):
         pass
 
+    async def key_family_stats(self) -> Dict[str, KeyFamilyStats]:
+        """Key count and size per key family (the first key segment after the prefix)."""
+        return {}
+
+    def _key_family(self, full_key: Union[str, bytes]) -> str:
+        if isinstance(full_key, bytes):
+            full_key = full_key.decode()
+        return full_key[len(self.prefix):].split(':', 1)[0]
+
+    def __get_task_ttl(self, data: TaskCacheData) -> Optional[int]:
+        return self.finished_ttl if data.status.is_finished else self.running_ttl
+
     @staticmethod
     def __get_message_id2task_id_key(message_id: str) -> str:
         return f'message_id2task_id:{message_id}'
@@ -29,13 +242,13 @@ class Cache:
             message_id: str,
             task_id: str
     ):
-        await self.set_value(key=self.__get_message_id2task_id_key(message_id), value=task_id)
+        await self.set_value(key=self.__get_message_id2task_id_key(message_id), value=task_id, ex=self.running_ttl)
 
     async def get_task_id_by_message_id(self, message_id: str) -> Optional[str]:
         value = await self.get_value(key=self.__get_message_id2task_id_key(message_id))
         if value:
             try:
-                return str(value)
+                return value.decode() if isinstance(value, bytes) else str(value)
             except Exception as e:
                 # TODO:
                 pass
@@ -50,13 +263,60 @@ class Cache:
             task_id: str,
             data: TaskCacheData
     ):
-        await self.set_value(key=self.__get_task_id2data_key(task_id), value=data.model_dump_json())
+        values = {self.__get_task_id2data_key(task_id): self.codec.encode(data)}
+        await self._write_task(task_id=task_id, data=data, values=values, ex=self.__get_task_ttl(data))
+        self._notify_task_listeners(task_id=task_id, data=data)
+
+    async def set_task(
+            self,
+            task_id: str,
+            data: TaskCacheData
+    ):
+        """Write the task data and, once it has a message, its message_id2task_id mapping in one round trip."""
+        values = {self.__get_task_id2data_key(task_id): self.codec.encode(data)}
+        if data.message_id:
+            values[self.__get_message_id2task_id_key(data.message_id)] = task_id
+        await self._write_task(task_id=task_id, data=data, values=values, ex=self.__get_task_ttl(data))
+        self._notify_task_listeners(task_id=task_id, data=data)
+
+    async def _write_task(self, task_id: str, data: TaskCacheData, values: Dict[str, Any], ex: Optional[int]):
+        await self.mset(values, ex=ex)
+        if data.status.is_finished:
+            await self.remove_set_members(self._running_task_ids_key, task_id)
+        else:
+            await self.add_set_members(self._running_task_ids_key, task_id)
+
+    # ids of every task which is not finished yet
+    _running_task_ids_key = 'running_task_ids'
+
+    async def get_running_task_ids(self) -> List[str]:
+        return await self.get_set_members(self._running_task_ids_key)
+
+    async def remove_running_task(self, task_id: str):
+        await self.remove_set_members(self._running_task_ids_key, task_id)
+
+    def _notify_task_listeners(self, task_id: str, data: TaskCacheData):
+        for listener in self.task_listeners:
+            listener(task_id, data)
+
+    async def get_task_data_by_id(self, task_id: str, refresh_ttl: bool = False) -> Optional[TaskCacheData]:
+        """With ``refresh_ttl`` the record is kept for another ``running_ttl`` or ``finished_ttl``, by its status."""
+        key = self.__get_task_id2data_key(task_id)
+        data = self.__decode_task_data(await self.get_value(key=key))
+        if refresh_ttl and data is not None:
+            ttl = self.__get_task_ttl(data)
+            if ttl:
+                await self.expire_value(key=key, ex=ttl)
+        return data
 
-    async def get_task_data_by_id(self, task_id: str) -> Optional[TaskCacheData]:
-        value = await self.get_value(key=self.__get_task_id2data_key(task_id))
+    async def get_tasks_data_by_ids(self, task_ids: List[str]) -> Dict[str, Optional[TaskCacheData]]:
+        values = await self.mget(keys=[self.__get_task_id2data_key(task_id) for task_id in task_ids])
+        return {task_id: self.__decode_task_data(value) for task_id, value in zip(task_ids, values)}
+
+    def __decode_task_data(self, value: Any) -> Optional[TaskCacheData]:
         if value:
             try:
-                return TaskCacheData.model_validate_json(value)
+                return self.codec.decode(value)
             except Exception as e:
                 # TODO:
                 pass
@@ -64,20 +324,172 @@ class Cache:
 
 
 class MemoryCache(Cache):
-    def __init__(self, prefix: str = ''):
-        super().__init__(prefix=prefix)
-        self.data = {}
+    """
+    In-process cache honouring ``ex`` with LRU eviction once ``max_entries`` or ``max_bytes`` is exceeded.
+
+    Expired entries are dropped lazily on read, and by a background sweeper when ``sweep_interval`` is set.
+    """
+
+    def __init__(
+            self,
+            prefix: str = '',
+            max_entries: Optional[int] = None,
+            max_bytes: Optional[int] = None,
+            sweep_interval: Optional[float] = None,
+            running_ttl: Optional[int] = None,
+            finished_ttl: Optional[int] = None,
+            codec: Optional[TaskDataCodec] = None
+    ):
+        super().__init__(prefix=prefix, running_ttl=running_ttl, finished_ttl=finished_ttl, codec=codec)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        # key -> (value, expires_at, size), ordered from least to most recently used
+        self.data: OrderedDict[str, Tuple[Any, Optional[float], int]] = OrderedDict()
+        # sets are indexes, they are neither expired nor evicted
+        self.sets: Dict[str, set] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__sweeper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def __sizeof(key: str, value: Any) -> int:
+        if isinstance(value, (str, bytes)):
+            value_size = len(value)
+        else:
+            value_size = sys.getsizeof(value)
+        return len(key) + value_size
+
+    def __delete(self, key: str):
+        _, _, size = self.data.pop(key)
+        self.bytes -= size
+
+    def __evict(self):
+        while self.data and (
+                (self.max_entries is not None and len(self.data) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            key = next(iter(self.data))
+            self.__delete(key)
+            self.evictions += 1
 
     async def set_value(self, key: str, value: Any, ex: Optional[int] = None):
-        self.data[f"{self.prefix}{key}"] = value
+        key = f"{self.prefix}{key}"
+        if key in self.data:
+            self.__delete(key)
+        expires_at = time.monotonic() + ex if ex else None
+        size = self.__sizeof(key, value)
+        self.data[key] = (value, expires_at, size)
+        self.bytes += size
+        self.__evict()
 
     async def get_value(self, key: str):
-        return self.data.get(f"{self.prefix}{key}")
+        key = f"{self.prefix}{key}"
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.__delete(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def get_value_ex(self, key: str, ex: Optional[int] = None):
+        value = await self.get_value(key=key)
+        full_key = f"{self.prefix}{key}"
+        if value is not None and ex:
+            _, _, size = self.data[full_key]
+            self.data[full_key] = (value, time.monotonic() + ex, size)
+        return value
+
+    async def expire_value(self, key: str, ex: int):
+        key = f"{self.prefix}{key}"
+        entry = self.data.get(key)
+        if entry is not None:
+            value, _, size = entry
+            self.data[key] = (value, time.monotonic() + ex, size)
+
+    async def key_family_stats(self) -> Dict[str, KeyFamilyStats]:
+        result: Dict[str, KeyFamilyStats] = {}
+        for key, (_, _, size) in self.data.items():
+            if not key.startswith(self.prefix):
+                continue
+            stats = result.setdefault(self._key_family(key), KeyFamilyStats())
+            stats.keys += 1
+            stats.bytes += size
+        return result
+
+    async def delete_value(self, key: str):
+        key = f"{self.prefix}{key}"
+        if key in self.data:
+            self.__delete(key)
+
+    def clear(self):
+        self.data.clear()
+        self.bytes = 0
+
+    async def add_set_members(self, key: str, *members: str):
+        self.sets.setdefault(f"{self.prefix}{key}", set()).update(members)
+
+    async def remove_set_members(self, key: str, *members: str):
+        members_set = self.sets.get(f"{self.prefix}{key}")
+        if members_set is not None:
+            members_set.difference_update(members)
+
+    async def get_set_members(self, key: str) -> List[str]:
+        return list(self.sets.get(f"{self.prefix}{key}", ()))
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at, _) in self.data.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            self.__delete(key)
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def __sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    def start_sweeper(self):
+        if self.sweep_interval and self.__sweeper is None:
+            self.__sweeper = asyncio.create_task(self.__sweep_forever())
+
+    async def close(self):
+        if self.__sweeper is not None:
+            self.__sweeper.cancel()
+            self.__sweeper = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self.data),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
 
 
 class RedisCache(Cache):
-    def __init__(self, redis: Redis, prefix: str = ''):
-        super().__init__(prefix=prefix)
+    def __init__(
+            self,
+            redis: Redis,
+            prefix: str = '',
+            running_ttl: Optional[int] = None,
+            finished_ttl: Optional[int] = None,
+            codec: Optional[TaskDataCodec] = None
+    ):
+        super().__init__(prefix=prefix, running_ttl=running_ttl, finished_ttl=finished_ttl, codec=codec)
         self.redis = redis
 
     async def set_value(self, key: str, value: Any, ex: Optional[int] = None):
@@ -86,6 +498,74 @@ class RedisCache(Cache):
     async def get_value(self, key: str):
         return await self.redis.get(name=f"{self.prefix}{key}")
 
+    async def get_value_ex(self, key: str, ex: Optional[int] = None):
+        if not ex:
+            return await self.get_value(key=key)
+        return await self.redis.getex(name=f"{self.prefix}{key}", ex=ex)
+
+    async def expire_value(self, key: str, ex: int):
+        await self.redis.expire(f"{self.prefix}{key}", ex)
+
+    async def delete_value(self, key: str):
+        await self.redis.delete(f"{self.prefix}{key}")
+
+    async def add_set_members(self, key: str, *members: str):
+        await self.redis.sadd(f"{self.prefix}{key}", *members)
+
+    async def remove_set_members(self, key: str, *members: str):
+        await self.redis.srem(f"{self.prefix}{key}", *members)
+
+    async def get_set_members(self, key: str) -> List[str]:
+        return [x.decode() for x in await self.redis.smembers(f"{self.prefix}{key}")]
+
+    async def _write_task(self, task_id: str, data: TaskCacheData, values: Dict[str, Any], ex: Optional[int]):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_task_write(pipe=pipe, task_id=task_id, data=data, values=values, ex=ex)
+            await pipe.execute()
+
+    def _queue_task_write(self, pipe, task_id: str, data: TaskCacheData, values: Dict[str, Any], ex: Optional[int]):
+        for key, value in values.items():
+            pipe.set(name=f"{self.prefix}{key}", value=value, ex=ex)
+        running_task_ids_key = f"{self.prefix}{self._running_task_ids_key}"
+        if data.status.is_finished:
+            pipe.srem(running_task_ids_key, task_id)
+        else:
+            pipe.sadd(running_task_ids_key, task_id)
+
+    async def key_family_stats(self, scan_count: int = 1000) -> Dict[str, KeyFamilyStats]:
+        result: Dict[str, KeyFamilyStats] = {}
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis.scan(cursor=cursor, match=f"{self.prefix}*", count=scan_count)
+            if keys:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.memory_usage(key)
+                    sizes = await pipe.execute()
+                for key, size in zip(keys, sizes):
+                    stats = result.setdefault(self._key_family(key), KeyFamilyStats())
+                    stats.keys += 1
+                    stats.bytes += size or 0
+            if cursor == 0:
+                return result
+
+    async def mget(self, keys: List[str]) -> List[Any]:
+        if not keys:
+            return []
+        return await self.redis.mget([f"{self.prefix}{key}" for key in keys])
+
+    async def mset(self, values: Dict[str, Any], ex: Optional[int] = None):
+        if not values:
+            return
+        if len(values) == 1:
+            key, value = next(iter(values.items()))
+            await self.set_value(key=key, value=value, ex=ex)
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for key, value in values.items():
+                pipe.set(name=f"{self.prefix}{key}", value=value, ex=ex)
+            await pipe.execute()
+
     async def close(self):
         await self.redis.close()
 
@@ -94,6 +574,118 @@ class RedisCache(Cache):
         redis = await from_url(
             redis_uri,
             encoding="utf-8",
-            decode_responses=True,
+            # task data may be stored in a binary codec, text values are decoded where they are read
+            decode_responses=False,
         )
         return redis
+
+
+class NearCachedRedisCache(RedisCache):
+    """
+    RedisCache with an in-process near cache of decoded task data in front of it.
+
+    Finished records are kept until evicted, unfinished ones for ``near_running_ttl`` seconds only.
+    Every task write is published on a Redis channel so other replicas drop their near copy. Writes of
+    other instances to the tasks ``remote_write_filter`` accepts are reloaded and passed to the task
+    listeners, which is how API workers learn about results written by the gateway. Only tasks somebody
+    waits for should pass, every reload is a Redis round trip.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            prefix: str = '',
+            running_ttl: Optional[int] = None,
+            finished_ttl: Optional[int] = None,
+            codec: Optional[TaskDataCodec] = None,
+            near_max_entries: int = 10000,
+            near_running_ttl: int = 2,
+            near_refresh_interval: int = 3600,
+            remote_write_filter: Optional[Callable[[str], bool]] = None
+    ):
+        super().__init__(redis=redis, prefix=prefix, running_ttl=running_ttl, finished_ttl=finished_ttl, codec=codec)
+        # decoded task data, keyed by task id, values are (data, loaded_at)
+        self.near = MemoryCache(max_entries=near_max_entries)
+        self.near_running_ttl = near_running_ttl
+        # finished records served from the near cache still get their redis ttl refreshed this often
+        self.near_refresh_interval = near_refresh_interval
+        self.instance_id = uuid.uuid4().hex
+        self.invalidation_channel = f"{prefix}task-invalidate"
+        self.remote_write_filter = remote_write_filter
+        self.__listener: Optional[asyncio.Task] = None
+
+    async def __near_set(self, task_id: str, data: TaskCacheData):
+        ex = None if data.status.is_finished else self.near_running_ttl
+        await self.near.set_value(key=task_id, value=(data, time.monotonic()), ex=ex)
+
+    def _queue_task_write(self, pipe, task_id: str, data: TaskCacheData, values: Dict[str, Any], ex: Optional[int]):
+        super()._queue_task_write(pipe=pipe, task_id=task_id, data=data, values=values, ex=ex)
+        pipe.publish(self.invalidation_channel, f"{self.instance_id}:{task_id}")
+
+    async def _write_task(self, task_id: str, data: TaskCacheData, values: Dict[str, Any], ex: Optional[int]):
+        await super()._write_task(task_id=task_id, data=data, values=values, ex=ex)
+        await self.__near_set(task_id=task_id, data=data)
+
+    async def get_task_data_by_id(self, task_id: str, refresh_ttl: bool = False) -> Optional[TaskCacheData]:
+        entry = await self.near.get_value(key=task_id)
+        if entry is not None:
+            data, loaded_at = entry
+            if not refresh_ttl or time.monotonic() - loaded_at < self.near_refresh_interval:
+                return data.model_copy()
+        data = await super().get_task_data_by_id(task_id=task_id, refresh_ttl=refresh_ttl)
+        if data is not None:
+            await self.__near_set(task_id=task_id, data=data)
+            return data.model_copy()
+        return None
+
+    async def get_tasks_data_by_ids(self, task_ids: List[str]) -> Dict[str, Optional[TaskCacheData]]:
+        result: Dict[str, Optional[TaskCacheData]] = {}
+        missing = []
+        for task_id in task_ids:
+            entry = await self.near.get_value(key=task_id)
+            if entry is None:
+                missing.append(task_id)
+            else:
+                result[task_id] = entry[0].model_copy()
+        if missing:
+            for task_id, data in (await super().get_tasks_data_by_ids(task_ids=missing)).items():
+                if data is not None:
+                    await self.__near_set(task_id=task_id, data=data)
+                    data = data.model_copy()
+                result[task_id] = data
+        return result
+
+    def start_invalidation_listener(self):
+        if self.__listener is None:
+            self.__listener = asyncio.create_task(self.__listen_invalidations())
+
+    async def __listen_invalidations(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.invalidation_channel)
+                    # anything written while we were not subscribed may be stale
+                    self.near.clear()
+                    async for message in pubsub.listen():
+                        if message['type'] != 'message':
+                            continue
+                        instance_id, task_id = message['data'].decode().split(':', 1)
+                        if instance_id == self.instance_id:
+                            continue
+                        await self.near.delete_value(key=task_id)
+                        if self.remote_write_filter and self.task_listeners and self.remote_write_filter(task_id):
+                            data = await self.get_task_data_by_id(task_id=task_id)
+                            if data is not None:
+                                self._notify_task_listeners(task_id=task_id, data=data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"task invalidation listener error: {e!r}")
+                self.near.clear()
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self.__listener is not None:
+            self.__listener.cancel()
+            self.__listener = None
+        await super().close()
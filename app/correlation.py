@@ -0,0 +1,121 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+import discord
+
+
+class _Waiter:
+    def __init__(self, keys: List[str], embeds_desc_keyword: str):
+        self.keys = keys
+        self.embeds_desc_keyword = embeds_desc_keyword
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class InteractionCorrelator:
+    """
+    Binds bot replies to the interaction that caused them.
+
+    Replies carrying interaction metadata are matched by interaction id / nonce, so any number
+    of submissions can be in flight at once, whatever they say (e.g. an error). Replies without
+    metadata fall back to the oldest waiter expecting the same keyword.
+    """
+
+    def __init__(self, bot_user_id: Optional[int] = None, unclaimed_buffer_size: int = 256):
+        self.bot_user_id = bot_user_id
+        self.unclaimed_buffer_size = unclaimed_buffer_size
+        self.__waiters: Dict[str, _Waiter] = {}
+        self.__fallback_waiters: Deque[_Waiter] = deque()
+        # replies that arrived before their waiter was registered
+        self.__unclaimed: OrderedDict[str, discord.Message] = OrderedDict()
+
+    @staticmethod
+    def interaction_keys(interaction: discord.Interaction) -> List[str]:
+        keys = [f'id:{interaction.id}']
+        if interaction.nonce:
+            keys.append(f'nonce:{interaction.nonce}')
+        return keys
+
+    @staticmethod
+    def message_keys(message: discord.Message) -> List[str]:
+        if not message.interaction:
+            return []
+        keys = [f'id:{message.interaction.id}']
+        nonce = getattr(message.interaction, 'nonce', None)
+        if nonce:
+            keys.append(f'nonce:{nonce}')
+        return keys
+
+    @staticmethod
+    def __has_keyword(message: discord.Message, embeds_desc_keyword: str) -> bool:
+        if not message.embeds:
+            return False
+        description = message.embeds[0].description
+        return bool(description) and embeds_desc_keyword.lower() in description.lower()
+
+    def feed(self, message: discord.Message) -> bool:
+        """Offer a new message to the pending waiters, returns True if it was bound to one."""
+        keys = self.message_keys(message)
+        if keys:
+            for key in keys:
+                waiter = self.__waiters.get(key)
+                if waiter and self.__resolve(waiter, message, by_key=True):
+                    return True
+            self.__buffer(message, keys)
+            return False
+
+        if not message.mentions or message.mentions[0].id != self.bot_user_id:
+            return False
+        for waiter in self.__fallback_waiters:
+            if self.__resolve(waiter, message, by_key=False):
+                return True
+        return False
+
+    def __buffer(self, message: discord.Message, keys: List[str]):
+        for key in keys:
+            self.__unclaimed[key] = message
+        while len(self.__unclaimed) > self.unclaimed_buffer_size:
+            self.__unclaimed.popitem(last=False)
+
+    def __resolve(self, waiter: _Waiter, message: discord.Message, by_key: bool) -> bool:
+        if waiter.future.done():
+            return False
+        # without metadata only the keyword tells whose reply it might be
+        if not by_key and not self.__has_keyword(message, waiter.embeds_desc_keyword):
+            return False
+        waiter.future.set_result(message)
+        return True
+
+    async def wait(
+            self,
+            interaction: discord.Interaction,
+            embeds_desc_keyword: str,
+            timeout: float
+    ) -> discord.Message:
+        waiter = _Waiter(keys=self.interaction_keys(interaction), embeds_desc_keyword=embeds_desc_keyword)
+        # a reply is buffered under each of its keys, take it out under all of them
+        buffered: List[discord.Message] = []
+        for key in waiter.keys:
+            message = self.__unclaimed.pop(key, None)
+            if message is not None and not any(x is message for x in buffered):
+                buffered.append(message)
+        matched = None
+        for message in buffered:
+            if matched is None and self.__resolve(waiter, message, by_key=True):
+                matched = message
+            else:
+                # another reply under one of our keys, leave it for whoever asks next
+                self.__buffer(message, self.message_keys(message))
+        if matched is not None:
+            return matched
+
+        for key in waiter.keys:
+            self.__waiters[key] = waiter
+        self.__fallback_waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter.future, timeout=timeout)
+        finally:
+            for key in waiter.keys:
+                if self.__waiters.get(key) is waiter:
+                    del self.__waiters[key]
+            self.__fallback_waiters.remove(waiter)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from starlette import status
@@ -17,3 +19,16 @@ async def api_auth(
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+
+async def metrics_auth(
+        token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(scheme_name="Metrics", auto_error=False)),
+        settings: Settings = Depends(get_settings)
+):
+    # /metrics is open unless a token is configured, scrapers send it as a bearer token
+    if settings.metrics_auth_token and (token is None or token.credentials != settings.metrics_auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
@@ -1,29 +1,136 @@
+import asyncio
 import enum
-from typing import Optional
+import time
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional
 
 import httpx
-from tenacity import retry, wait_fixed, stop_after_attempt
+from pydantic import BaseModel
+from tenacity import AsyncRetrying, wait_exponential, stop_after_attempt
 
-from app.schema import TaskCacheData, TaskStateOut
+from app.metrics import observe_stage
+from app.schema import Mode, TaskCacheData, TaskCommand, TaskStateOut
 
 
 class EventType(enum.Enum):
     TASK_SUCCESS = "TASK_SUCCESS"
+    TASK_FAILED = "TASK_FAILED"
+
+
+class DeadLetter(BaseModel):
+    payload: dict
+    error: str
+    failed_at: float
+
+
+class OutboxEntry(NamedTuple):
+    payload: dict
+    # labels of the delivery latency
+    command: TaskCommand
+    mode: Optional[Mode]
+    # time.monotonic() of the enqueue
+    enqueued_at: float
 
 
 class EventCallback:
+    """
+    Delivers task events to ``callback_url`` in the background.
 
-    def __init__(self, callback_url: Optional[str]):
+    Result handlers only enqueue into a bounded outbox; a pool of workers posts through one shared
+    keep-alive client, retrying with exponential backoff, and events that still fail (or don't fit
+    in the outbox) end up in ``dead_letters``.
+    """
+
+    def __init__(
+            self,
+            callback_url: Optional[str],
+            workers: int = 4,
+            outbox_size: int = 1000,
+            max_attempts: int = 5,
+            backoff_max: float = 30,
+            timeout: float = 10,
+            http2: bool = False,
+            dead_letter_size: int = 1000
+    ):
         self.callback_url = callback_url
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.http2 = http2
+        self.outbox: asyncio.Queue[OutboxEntry] = asyncio.Queue(maxsize=outbox_size)
+        self.dead_letters: Deque[DeadLetter] = deque(maxlen=dead_letter_size)
+        self.client: Optional[httpx.AsyncClient] = None
+        self.__tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self.callback_url:
+            return
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+        )
+        for _ in range(self.workers):
+            self.__tasks.append(asyncio.create_task(self.__run()))
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks.clear()
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    @property
+    def backlog(self) -> int:
+        return self.outbox.qsize()
 
-    @retry(wait=wait_fixed(2), stop=stop_after_attempt(3), reraise=False)
     async def send_task_success(self, task_id: str, data: TaskCacheData):
+        self.__enqueue(event=EventType.TASK_SUCCESS, task_id=task_id, data=data)
+
+    async def send_task_failed(self, task_id: str, data: TaskCacheData):
+        self.__enqueue(event=EventType.TASK_FAILED, task_id=task_id, data=data)
+
+    def __enqueue(self, event: EventType, task_id: str, data: TaskCacheData):
         if not self.callback_url:
             return
         out = TaskStateOut.from_cache_data(data)
-        async with httpx.AsyncClient() as client:
-            await client.post(self.callback_url, json={
-                'event': EventType.TASK_SUCCESS.value,
-                'task_id': task_id,
-                'data': out.model_dump_json()
-            })
+        payload = {
+            'event': event.value,
+            'task_id': task_id,
+            'data': out.model_dump_json()
+        }
+        try:
+            self.outbox.put_nowait(OutboxEntry(
+                payload=payload,
+                command=data.command,
+                mode=data.mode,
+                enqueued_at=time.monotonic()
+            ))
+        except asyncio.QueueFull:
+            self.dead_letters.append(DeadLetter(payload=payload, error='outbox is full', failed_at=time.time()))
+
+    async def __run(self):
+        while True:
+            entry = await self.outbox.get()
+            payload = entry.payload
+            try:
+                await self.__deliver(payload)
+                observe_stage('webhook', time.monotonic() - entry.enqueued_at, command=entry.command, mode=entry.mode)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"event callback failed, task_id: {payload['task_id']}, error: {e!r}")
+                self.dead_letters.append(DeadLetter(payload=payload, error=repr(e), failed_at=time.time()))
+
+    async def __deliver(self, payload: dict):
+        async for attempt in AsyncRetrying(
+                wait=wait_exponential(multiplier=1, max=self.backoff_max),
+                stop=stop_after_attempt(self.max_attempts),
+                reraise=True
+        ):
+            with attempt:
+                response = await self.client.post(self.callback_url, json=payload)
+                response.raise_for_status()
@@ -0,0 +1,134 @@
+import asyncio
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from redis.asyncio import Redis
+
+# only the holder may extend or release the lease
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderElection:
+    """
+    Redis lease lock electing the one replica which runs the discord gateway.
+
+    The leader renews its lease every ``heartbeat_interval`` seconds, followers try to take it just as
+    often, so when a leader dies another replica takes over at most ``lease + heartbeat_interval``
+    seconds later. A leader which can't renew steps down before its lease runs out, and ``on_elected``
+    runs in a task of its own so the lease is renewed while the gateway starts.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            key: str,
+            on_elected: Callable[[], Awaitable[None]],
+            on_demoted: Callable[[], Awaitable[None]],
+            lease: float = 10,
+            heartbeat_interval: float = 3
+    ):
+        self.redis = redis
+        self.key = key
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.lease = lease
+        self.heartbeat_interval = heartbeat_interval
+        self.instance_id = uuid.uuid4().hex
+        self.is_leader = False
+        self.leader_since: Optional[float] = None
+        # time.monotonic() until which our lease is known to be valid
+        self.__lease_until = 0.0
+        self.__renew = redis.register_script(RENEW_SCRIPT)
+        self.__release = redis.register_script(RELEASE_SCRIPT)
+        self.__task: Optional[asyncio.Task] = None
+        # runs on_elected, cancelled if we step down before it is done
+        self.__start_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+        if self.is_leader:
+            await self.__step_down()
+            try:
+                await self.__release(keys=[self.key], args=[self.instance_id])
+            except Exception as e:
+                print(f"leader release failed: {e!r}")
+
+    async def get_leader_id(self) -> Optional[str]:
+        value = await self.redis.get(self.key)
+        return value.decode() if value else None
+
+    async def __run(self):
+        while True:
+            started_at = time.monotonic()
+            try:
+                if self.is_leader:
+                    # a hung call must not keep us from stepping down in time
+                    if await asyncio.wait_for(
+                            self.__renew(keys=[self.key], args=[self.instance_id, int(self.lease * 1000)]),
+                            timeout=self.heartbeat_interval
+                    ):
+                        self.__lease_until = started_at + self.lease
+                    else:
+                        print(f"leader lease lost, instance_id: {self.instance_id}")
+                        await self.__step_down()
+                elif await asyncio.wait_for(
+                        self.redis.set(self.key, self.instance_id, nx=True, px=int(self.lease * 1000)),
+                        timeout=self.heartbeat_interval
+                ):
+                    self.__lease_until = started_at + self.lease
+                    await self.__step_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"leader election error: {e!r}")
+                # stop before another replica may hold the lease
+                if self.is_leader and time.monotonic() + self.heartbeat_interval >= self.__lease_until:
+                    await self.__step_down()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def __step_up(self):
+        print(f"elected as gateway leader, instance_id: {self.instance_id}")
+        self.is_leader = True
+        self.leader_since = time.time()
+        self.__start_task = asyncio.create_task(self.__start())
+
+    async def __start(self):
+        try:
+            await self.on_elected()
+        except Exception as e:
+            print(f"gateway start failed: {e!r}")
+            await self.__step_down()
+            try:
+                await self.__release(keys=[self.key], args=[self.instance_id])
+            except Exception as e:
+                print(f"leader release failed: {e!r}")
+
+    async def __step_down(self):
+        self.is_leader = False
+        self.leader_since = None
+        start_task, self.__start_task = self.__start_task, None
+        if start_task and start_task is not asyncio.current_task() and not start_task.done():
+            start_task.cancel()
+            await asyncio.gather(start_task, return_exceptions=True)
+        try:
+            await self.on_demoted()
+        except Exception as e:
+            print(f"gateway stop failed: {e!r}")
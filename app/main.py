@@ -1,19 +1,33 @@
 import asyncio
-import io
+import json
+import time
 import uuid
-from typing import Optional
+from typing import Dict, List, Optional
 
-import discord
-from fastapi import FastAPI, Request, UploadFile, Form, HTTPException, Depends
+from fastapi import FastAPI, Request, UploadFile, Form, HTTPException, Depends, Query
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette import status
-from starlette.responses import JSONResponse
-
-from app.cache import RedisCache, MemoryCache, Cache
-from app.dependencies import api_auth
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from app.account_pool import DiscordUserClientPool, NoAvailableAccountError
+from app.action_queue import ActionQueue, ActionQueueFullError, ActionQueueWorker, ActionType, \
+    AnimateActionParams, ButtonActionParams, GenActionParams, MemoryActionQueue, MoveActionParams, QueuedFile, \
+    RealActionParams, RedisActionQueue, VideoActionParams, new_action
+from app.cache import RedisCache, MemoryCache, Cache, NearCachedRedisCache, get_task_data_codec
+from app.dependencies import api_auth, metrics_auth
+from app.event_callback import EventCallback
+from app.leader import LeaderElection
+from app.media import MediaInspector, MediaPreprocessor, MediaRejectedError
+from app.metrics import ACTION_QUEUE_DEPTH, EVENT_CALLBACK_BACKLOG, EVENT_CALLBACK_DEAD_LETTERS, IN_FLIGHT_TASKS, \
+    observe_stage, set_cache_stats, set_gateway_event_stats
 from app.models import GenModel, MoveModel, VideoModel, get_v2v_model_info_by_instructions
 from app.schema import VideoReferMode, VideoLength, TaskCacheData, TaskStatus, CreateTaskOut, \
-    TaskCommand, TaskStateOut, AnimateLength, AnimateIntensity, Mode, VideoKey, VideoApiError
+    TaskCommand, TaskStateOut, AnimateLength, AnimateIntensity, Mode, VideoKey, VideoApiError, TaskDataBatchIn, \
+    TaskDataBatchOut
 from app.settings import get_settings
+from app.task_events import TaskEventHub
+from app.task_watchdog import TaskWatchdog
+from app.upload_cache import UploadCache
 from app.user_client import DiscordUserClient
 
 app = FastAPI()
@@ -21,32 +35,123 @@ app = FastAPI()
 settings = get_settings()
 
 
-async def __did_send_interaction(
-        wait_message_desc_keyword: str,
-        discord_user_client: DiscordUserClient,
-        cache: Cache,
-        command: TaskCommand
-) -> CreateTaskOut:
-    message: discord.Message = await discord_user_client.wait_for_generating_message(
-        embeds_desc_keyword=wait_message_desc_keyword
+@app.middleware("http")
+async def received_at_middleware(request: Request, call_next):
+    # start of the api_upload stage, before the multipart body is read
+    request.state.received_at = time.monotonic()
+    return await call_next(request)
+
+
+@app.exception_handler(NoAvailableAccountError)
+async def no_available_account_exception_handler(request: Request, exc: NoAvailableAccountError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "No discord account available"}
+    )
+
+
+@app.exception_handler(ActionQueueFullError)
+async def action_queue_full_exception_handler(request: Request, exc: ActionQueueFullError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Action queue is full"}
+    )
+
+
+@app.exception_handler(MediaRejectedError)
+async def media_rejected_exception_handler(request: Request, exc: MediaRejectedError):
+    return JSONResponse(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        content={"error": exc.code.value, "detail": str(exc)}
     )
+
+
+async def __read_upload(upload: UploadFile) -> QueuedFile:
+    # copied from the request's spooled file to a file of our own, it outlives the request
+    await upload.seek(0)
+    return await asyncio.to_thread(QueuedFile.spool, upload.file, upload.filename, settings.upload_spool_dir)
+
+
+async def __read_uploads(uploads: Dict[str, Optional[UploadFile]]) -> Dict[str, QueuedFile]:
+    files = {}
+    try:
+        for name, upload in uploads.items():
+            if upload:
+                files[name] = await __read_upload(upload)
+    except BaseException:
+        for file in files.values():
+            file.discard()
+        raise
+    return files
+
+
+async def __prepare_files(
+        request: Request,
+        files: Dict[str, QueuedFile],
+        video_length: Optional[VideoLength] = None
+):
+    media_inspector: MediaInspector = request.app.state.media_inspector
+    media_preprocessor: Optional[MediaPreprocessor] = request.app.state.media_preprocessor
+    # probed metadata of each upload, None for formats the prober doesn't know
+    request.state.media = {}
+    for name, file in files.items():
+        request.state.media[name] = await media_inspector.inspect(field=name, file=file, video_length=video_length)
+        if name != 'video' and media_preprocessor:
+            await media_preprocessor.prepare_image(field=name, file=file)
+        media_inspector.check_size(field=name, file=file)
+
+
+async def __enqueue_action(
+        request: Request,
+        action_type: ActionType,
+        command: TaskCommand,
+        params,
+        files: Optional[Dict[str, QueuedFile]] = None,
+        source_task: Optional[TaskCacheData] = None,
+        video_length: Optional[VideoLength] = None
+) -> CreateTaskOut:
+    cache: Cache = request.app.state.cache
+    action_queue: ActionQueue = request.app.state.action_queue
     task_id = str(uuid.uuid4())
-    await cache.set_message_id2task_id(message_id=str(message.id), task_id=task_id)
-    await cache.set_task_id2data(task_id=task_id, data=TaskCacheData(
-        command=command,
-        status=TaskStatus.RUNNING,
-        channel_id=str(discord_user_client.channel_id),
-        guild_id=str(discord_user_client.guild_id),
-        message_id=str(message.id)
-    ))
+    files = files or {}
+    # the spooled files belong to the queue once put succeeded, until then to us whatever goes wrong
+    try:
+        await __prepare_files(request=request, files=files, video_length=video_length)
+        action = new_action(
+            task_id=task_id,
+            action_type=action_type,
+            command=command,
+            params=params,
+            files=files,
+            source_task=source_task
+        )
+        data = TaskCacheData(
+            command=command,
+            status=TaskStatus.QUEUED,
+            created_at=action.enqueued_at,
+            mode=action.mode
+        )
+        await cache.set_task_id2data(task_id=task_id, data=data)
+        try:
+            await action_queue.put(action)
+        except ActionQueueFullError:
+            data.status = TaskStatus.FAILED
+            data.error = 'action queue is full'
+            await cache.set_task_id2data(task_id=task_id, data=data)
+            raise
+    except BaseException:
+        for file in files.values():
+            file.discard()
+        raise
+    observe_stage('api_upload', time.monotonic() - request.state.received_at, command=command, mode=action.mode)
     return CreateTaskOut(
         success=True,
         task_id=task_id,
-        message_id=str(message.id)
+        status=TaskStatus.QUEUED
     )
 
 
-@app.post("/v1/gen")
+@app.post("/v1/gen", status_code=status.HTTP_202_ACCEPTED)
 async def gen_api(
         request: Request,
         auth=Depends(api_auth),
@@ -55,29 +160,17 @@ async def gen_api(
         mode: Optional[Mode] = Form(default=None),
         model: Optional[GenModel] = Form(default=None)
 ):
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-    if image:
-        image_bytes = await image.read()
-        image_file = discord.File(io.BytesIO(image_bytes), filename=image.filename)
-    else:
-        image_file = None
-    interaction = await discord_user_client.gen(prompt=prompt, image=image_file, mode=mode, model=model)
-    print(f"gen, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Waiting to start',
+    files = await __read_uploads(dict(image=image))
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.GEN,
         command=TaskCommand.GEN,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=GenActionParams(prompt=prompt, mode=mode, model=model),
+        files=files
     )
-    return result
 
 
-@app.post("/v1/real")
+@app.post("/v1/real", status_code=status.HTTP_202_ACCEPTED)
 async def real_api(
         request: Request,
         auth=Depends(api_auth),
@@ -85,26 +178,17 @@ async def real_api(
         prompt: Optional[str] = Form(default=None),
         mode: Optional[Mode] = Form(default=None)
 ):
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-    image_bytes = await image.read()
-    image_file = discord.File(io.BytesIO(image_bytes), filename=image.filename)
-    interaction = await discord_user_client.real(prompt=prompt, image=image_file, mode=mode)
-    print(f"real, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Waiting to start',
+    files = await __read_uploads(dict(image=image))
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.REAL,
         command=TaskCommand.REAL,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=RealActionParams(prompt=prompt, mode=mode),
+        files=files
     )
-    return result
 
 
-@app.post("/v1/animate")
+@app.post("/v1/animate", status_code=status.HTTP_202_ACCEPTED)
 async def animate_api(
         request: Request,
         auth=Depends(api_auth),
@@ -114,43 +198,26 @@ async def animate_api(
         prompt: Optional[str] = Form(default=None),
         mode: Optional[Mode] = Form(default=None)
 ):
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-    image_bytes = await image.read()
-    image_file = discord.File(io.BytesIO(image_bytes), filename=image.filename)
-    interaction = await discord_user_client.animate(
-        prompt=prompt,
-        image=image_file,
-        length=length,
-        intensity=intensity,
-        mode=mode
-    )
-    print(f"animate, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Waiting to start',
+    files = await __read_uploads(dict(image=image))
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.ANIMATE,
         command=TaskCommand.ANIMATE,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=AnimateActionParams(prompt=prompt, length=length, intensity=intensity, mode=mode),
+        files=files
     )
-    return result
 
 
-@app.post("/v1/upscale")
+@app.post("/v1/upscale", status_code=status.HTTP_202_ACCEPTED)
 async def upscale_api(
         request: Request,
         auth=Depends(api_auth),
         task_id: str = Form(...),
         index: int = Form(..., ge=1, le=4)
 ):
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-
     cache: Cache = request.app.state.cache
-    data = await cache.get_task_data_by_id(task_id=task_id)
-    if not data:
+    data = await cache.get_task_data_by_id(task_id=task_id, refresh_ttl=True)
+    if not data or not data.upscale_custom_ids:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
         )
@@ -160,34 +227,25 @@ async def upscale_api(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
         )
-    interaction = await discord_user_client.click_button(custom_id=custom_id, message_id=int(data.message_id))
-    print(f"upscale, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Waiting to start',
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.UPSCALE,
         command=TaskCommand.GEN,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=ButtonActionParams(custom_id=custom_id, message_id=data.message_id),
+        source_task=data
     )
-    return result
 
 
-@app.post("/v1/vary")
+@app.post("/v1/vary", status_code=status.HTTP_202_ACCEPTED)
 async def vary_api(
         request: Request,
         auth=Depends(api_auth),
         task_id: str = Form(...),
         index: int = Form(..., ge=1, le=4)
 ):
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-
     cache: Cache = request.app.state.cache
-    data = await cache.get_task_data_by_id(task_id=task_id)
-    if not data:
+    data = await cache.get_task_data_by_id(task_id=task_id, refresh_ttl=True)
+    if not data or not data.vary_custom_ids:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
         )
@@ -197,23 +255,16 @@ async def vary_api(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
         )
-    interaction = await discord_user_client.click_button(custom_id=custom_id, message_id=int(data.message_id))
-    print(f"vary, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Waiting to start',
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.VARY,
         command=TaskCommand.GEN,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=ButtonActionParams(custom_id=custom_id, message_id=data.message_id),
+        source_task=data
     )
-    return result
 
 
-@app.post("/v1/video")
+@app.post("/v1/video", status_code=status.HTTP_202_ACCEPTED)
 async def video_api(
         request: Request,
         video: UploadFile,
@@ -229,67 +280,53 @@ async def video_api(
         mode: Optional[Mode] = Form(default=None),
 ):
     # size_mb = video.size / 1024.0 / 1024.0
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-    video_bytes = await video.read()
-    video_file = discord.File(io.BytesIO(video_bytes), filename=video.filename)
-    image_file = None
-    if image:
-        image_bytes = await image.read()
-        image_file = discord.File(io.BytesIO(image_bytes), filename=image.filename)
-
     model_info = get_v2v_model_info_by_instructions(model.value)
     if model_info is None:
         return JSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
-            content={"code": VideoApiError.VIDEO_MODEL_ERROR}
+            content={"code": VideoApiError.VIDEO_MODEL_ERROR.value}
         )
 
     if refer_mode not in model_info.allowed_refer_modes:
         return JSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
-            content={"error": VideoApiError.NOT_ALLOW_REFER}
+            content={"error": VideoApiError.NOT_ALLOW_REFER.value}
         )
 
     if not model_info.allowed_lip_sync and lip_sync:
         return JSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
-            content={"error": VideoApiError.NOT_ALLOW_LIP_SYNC}
+            content={"error": VideoApiError.NOT_ALLOW_LIP_SYNC.value}
         )
 
     if model_info.allowed_reference_image and image is None:
         return JSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
-            content={"error": VideoApiError.MODEL_NEED_REFERENCE_IMAGE}
+            content={"error": VideoApiError.MODEL_NEED_REFERENCE_IMAGE.value}
         )
 
-    interaction = await discord_user_client.video(
-        prompt=prompt,
-        video=video_file,
-        image=image_file,
-        model=model,
-        refer_mode=refer_mode,
-        length=length,
-        mode=mode,
-        video_key=video_key,
-        subject_only=subject_only,
-        lip_sync=lip_sync,
-    )
-    print(f"video, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
+    files = await __read_uploads(dict(video=video, image=image))
 
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Generating',
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.VIDEO,
         command=TaskCommand.VIDEO,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=VideoActionParams(
+            prompt=prompt,
+            model=model,
+            refer_mode=refer_mode,
+            length=length,
+            mode=mode,
+            video_key=video_key,
+            subject_only=subject_only,
+            lip_sync=lip_sync,
+        ),
+        files=files,
+        video_length=length
     )
-    return result
 
 
-@app.post("/v1/move")
+@app.post("/v1/move", status_code=status.HTTP_202_ACCEPTED)
 async def move_api(
         request: Request,
         image: UploadFile,
@@ -302,80 +339,322 @@ async def move_api(
         mode: Optional[Mode] = Form(default=None),
 ):
     # size_mb = video.size / 1024.0 / 1024.0
-    discord_user_client: DiscordUserClient = request.app.state.discord_user_client
-    image_bytes = await image.read()
-    image_file = discord.File(io.BytesIO(image_bytes), filename=image.filename)
-    video_bytes = await video.read()
-    video_file = discord.File(io.BytesIO(video_bytes), filename=video.filename)
-    interaction = await discord_user_client.move(
-        prompt=prompt,
-        image=image_file,
-        video=video_file,
-        model=model,
-        length=length,
-        mode=mode,
-        video_key=video_key,
-    )
-    print(f"move, interaction_id: {interaction.id}, interaction.nonce: {interaction.nonce}")
-
-    if not interaction.successful:
-        # TODO:
-        return {"success": interaction.successful}
-
-    result = await __did_send_interaction(
-        wait_message_desc_keyword='Generating',
+    files = await __read_uploads(dict(image=image, video=video))
+    return await __enqueue_action(
+        request=request,
+        action_type=ActionType.MOVE,
         command=TaskCommand.MOVE,
-        cache=request.app.state.cache,
-        discord_user_client=discord_user_client
+        params=MoveActionParams(
+            prompt=prompt,
+            model=model,
+            length=length,
+            mode=mode,
+            video_key=video_key,
+        ),
+        files=files,
+        video_length=length
     )
-    return result
 
 
 @app.get("/v1/task-data/{task_id}")
 async def task_data(
         request: Request,
         task_id: str,
+        auth=Depends(api_auth),
+        wait: int = Query(default=0, ge=0, le=60, description="seconds to wait for the task to finish")
+):
+    cache: Cache = request.app.state.cache
+    task_event_hub: TaskEventHub = request.app.state.task_event_hub
+    # subscribe before reading so a change landing in between is not missed
+    with task_event_hub.subscribe(task_id=task_id) as events:
+        data = await cache.get_task_data_by_id(task_id=task_id, refresh_ttl=True)
+        if not data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        deadline = time.monotonic() + wait
+        while not data.status.is_finished:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                _, data = await asyncio.wait_for(events.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+    return TaskStateOut.from_cache_data(data=data)
+
+
+@app.post("/v1/task-data:batch")
+async def task_data_batch(
+        request: Request,
+        body: TaskDataBatchIn,
         auth=Depends(api_auth)
+) -> TaskDataBatchOut:
+    cache: Cache = request.app.state.cache
+    task_ids = list(dict.fromkeys(body.task_ids))
+    data_map = await cache.get_tasks_data_by_ids(task_ids=task_ids)
+    tasks = {}
+    missing = []
+    for task_id in task_ids:
+        data = data_map.get(task_id)
+        if data is None:
+            missing.append(task_id)
+        else:
+            tasks[task_id] = TaskStateOut.from_cache_data(data=data)
+    return TaskDataBatchOut(tasks=tasks, missing=missing)
+
+
+@app.get("/v1/tasks/events")
+async def task_events(
+        request: Request,
+        auth=Depends(api_auth),
+        task_id: Optional[List[str]] = Query(default=None, description="only stream events of these tasks")
 ):
+    task_event_hub: TaskEventHub = request.app.state.task_event_hub
+    task_ids = set(task_id) if task_id else None
+
+    async def event_stream():
+        with task_event_hub.subscribe() as events:
+            while not await request.is_disconnected():
+                try:
+                    event_task_id, data = await asyncio.wait_for(events.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if task_ids is not None and event_task_id not in task_ids:
+                    continue
+                payload = json.dumps({
+                    'task_id': event_task_id,
+                    'data': TaskStateOut.from_cache_data(data).model_dump(mode='json')
+                })
+                yield f"event: task\ndata: {payload}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/health")
+async def health(request: Request):
+    leader_election: Optional[LeaderElection] = request.app.state.leader_election
+    discord_user_client_pool: Optional[DiscordUserClientPool] = request.app.state.discord_user_client_pool
+    gateway = None
+    if discord_user_client_pool:
+        gateway = {
+            'accounts': len(discord_user_client_pool.clients),
+            'ready_accounts': len([x for x in discord_user_client_pool.clients if x.is_ready()])
+        }
+    leader = None
+    if leader_election:
+        leader = {
+            'instance_id': leader_election.instance_id,
+            'is_leader': leader_election.is_leader,
+            'leader_since': leader_election.leader_since,
+            'leader_id': await leader_election.get_leader_id()
+        }
+    return {
+        'role': settings.role,
+        'gateway': gateway,
+        'leader': leader
+    }
+
+
+@app.get("/metrics")
+async def metrics(request: Request, auth=Depends(metrics_auth)):
     cache: Cache = request.app.state.cache
-    data = await cache.get_task_data_by_id(task_id=task_id)
-    if not data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
+    if isinstance(cache, MemoryCache):
+        set_cache_stats('task', hits=cache.hits, misses=cache.misses)
+    elif isinstance(cache, NearCachedRedisCache):
+        set_cache_stats('near', hits=cache.near.hits, misses=cache.near.misses)
+    ACTION_QUEUE_DEPTH.set(await request.app.state.action_queue.qsize())
+    event_callback: EventCallback = request.app.state.event_callback
+    EVENT_CALLBACK_BACKLOG.set(event_callback.backlog)
+    EVENT_CALLBACK_DEAD_LETTERS.set(len(event_callback.dead_letters))
+
+    # accounts come and go with the gateway leadership
+    IN_FLIGHT_TASKS.clear()
+    gateway_event_stats = {}
+    discord_user_client_pool: Optional[DiscordUserClientPool] = request.app.state.discord_user_client_pool
+    if discord_user_client_pool:
+        upload_hits = upload_misses = 0
+        for client in discord_user_client_pool.clients:
+            account = client.account_id or str(client.channel_id)
+            IN_FLIGHT_TASKS.labels(account=account).set(client.in_flight_count)
+            gateway_event_stats[account] = (client.handled_edits, client.skipped_edits, client.dropped_events)
+            upload_hits += client.upload_cache.entries.hits
+            upload_misses += client.upload_cache.entries.misses
+        set_cache_stats('upload', hits=upload_hits, misses=upload_misses)
+    set_gateway_event_stats(gateway_event_stats)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def __start_gateway():
+    discord_user_client_pool = DiscordUserClientPool()
+    app.state.discord_user_client_pool = discord_user_client_pool
+    for account in settings.get_discord_accounts():
+        discord_user_client = DiscordUserClient(
+            guild_id=account.guild_id,
+            channel_id=account.channel_id,
+            application_id=settings.domoai_application_id,
+            cache=app.state.cache,
+            event_callback=app.state.event_callback,
+            progress_min_interval=settings.task_progress_min_interval,
+            reconcile_request_interval=settings.reconcile_request_interval,
+            reconcile_max_history=settings.reconcile_max_history,
+            upload_cache=UploadCache(ttl=settings.upload_cache_ttl, max_entries=settings.upload_cache_max_entries),
+            command_cache_ttl=settings.slash_command_cache_ttl,
+            lean=settings.gateway_lean_mode,
+            log_sample_rate=settings.gateway_log_sample_rate
         )
-    return TaskStateOut.from_cache_data(data=data)
+        await discord_user_client_pool.start(client=discord_user_client, token=account.token)
+
+    recovered = await app.state.action_queue.recover()
+    if recovered:
+        print(f"recovered unacknowledged actions: {recovered}")
+    app.state.action_queue_worker = ActionQueueWorker(
+        queue=app.state.action_queue,
+        pool=discord_user_client_pool,
+        cache=app.state.cache,
+        event_callback=app.state.event_callback,
+        max_concurrent_per_account=settings.account_max_concurrent_submissions,
+        ready_timeout=settings.account_ready_timeout
+    )
+    app.state.action_queue_worker.start()
+
+    app.state.task_watchdog = TaskWatchdog(
+        cache=app.state.cache,
+        pool=discord_user_client_pool,
+        event_callback=app.state.event_callback,
+        deadlines=settings.task_deadlines,
+        queued_deadline=settings.task_queued_deadline,
+        interval=settings.task_watchdog_interval
+    )
+    app.state.task_watchdog.start()
+
+
+async def __stop_gateway():
+    task_watchdog: Optional[TaskWatchdog] = app.state.task_watchdog
+    if task_watchdog:
+        await task_watchdog.close()
+        app.state.task_watchdog = None
+
+    action_queue_worker: Optional[ActionQueueWorker] = app.state.action_queue_worker
+    if action_queue_worker:
+        await action_queue_worker.close()
+        app.state.action_queue_worker = None
+
+    discord_user_client_pool: Optional[DiscordUserClientPool] = app.state.discord_user_client_pool
+    if discord_user_client_pool:
+        await discord_user_client_pool.close()
+        app.state.discord_user_client_pool = None
 
 
 @app.on_event("startup")
 async def startup_event():
+    shared_queue = settings.role != 'all' or settings.leader_election_enabled
+    if shared_queue and not (settings.redis_uri and settings.near_cache_enabled):
+        raise RuntimeError("split roles and leader election need REDIS_URI and NEAR_CACHE_ENABLED")
+    if shared_queue and not settings.media_max_upload_bytes:
+        # uploads travel through redis with the queued action
+        raise RuntimeError("split roles and leader election need MEDIA_MAX_UPLOAD_BYTES")
+
+    app.state.task_event_hub = TaskEventHub()
+
+    redis = None
     if settings.redis_uri:
         redis = await RedisCache.init_redis_pool(redis_uri=settings.redis_uri)
-        app.state.cache = RedisCache(redis=redis, prefix=settings.cache_prefix)
+        cache_options = dict(
+            redis=redis,
+            prefix=settings.cache_prefix,
+            running_ttl=settings.task_running_ttl,
+            finished_ttl=settings.task_finished_ttl,
+            codec=get_task_data_codec(settings.cache_codec)
+        )
+        if settings.near_cache_enabled:
+            app.state.cache = NearCachedRedisCache(
+                near_max_entries=settings.near_cache_max_entries,
+                near_running_ttl=settings.near_cache_running_ttl,
+                # results are written by whichever process runs the gateway, reload the ones somebody waits for
+                remote_write_filter=app.state.task_event_hub.has_subscribers,
+                **cache_options
+            )
+            app.state.cache.start_invalidation_listener()
+        else:
+            app.state.cache = RedisCache(**cache_options)
     else:
-        app.state.cache = MemoryCache(prefix=settings.cache_prefix)
+        app.state.cache = MemoryCache(
+            prefix=settings.cache_prefix,
+            max_entries=settings.memory_cache_max_entries,
+            max_bytes=settings.memory_cache_max_bytes,
+            sweep_interval=settings.memory_cache_sweep_interval,
+            running_ttl=settings.task_running_ttl,
+            finished_ttl=settings.task_finished_ttl,
+            codec=get_task_data_codec(settings.cache_codec)
+        )
+        app.state.cache.start_sweeper()
 
-    discord_user_client = DiscordUserClient(
-        guild_id=settings.discord_guild_id,
-        channel_id=settings.discord_channel_id,
-        application_id=settings.domoai_application_id,
-        cache=app.state.cache,
-        event_callback_url=settings.event_callback_url
+    app.state.media_inspector = MediaInspector(
+        max_upload_bytes=settings.media_max_upload_bytes,
+        video_max_side=settings.media_video_max_side
     )
+    app.state.media_preprocessor = None
+    if settings.media_preprocessing_enabled:
+        app.state.media_preprocessor = MediaPreprocessor(
+            image_reencode_bytes=settings.media_image_reencode_bytes,
+            jpeg_quality=settings.media_jpeg_quality
+        )
 
-    app.state.discord_user_client = discord_user_client
-    await discord_user_client.login(settings.discord_token)
-    app.state.discord_start_task = asyncio.create_task(discord_user_client.connect(reconnect=True))
-    await discord_user_client.wait_until_ready()
+    app.state.cache.add_task_listener(app.state.task_event_hub.publish)
+
+    if not shared_queue:
+        app.state.action_queue = MemoryActionQueue(max_size=settings.action_queue_max_size)
+    else:
+        app.state.action_queue = RedisActionQueue(
+            redis=redis,
+            prefix=settings.cache_prefix,
+            max_size=settings.action_queue_max_size,
+            spool_dir=settings.upload_spool_dir
+        )
+
+    app.state.event_callback = EventCallback(
+        callback_url=settings.event_callback_url,
+        workers=settings.event_callback_workers,
+        outbox_size=settings.event_callback_outbox_size,
+        max_attempts=settings.event_callback_max_attempts,
+        http2=settings.event_callback_http2
+    )
+    app.state.discord_user_client_pool = None
+    app.state.action_queue_worker = None
+    app.state.task_watchdog = None
+    app.state.leader_election = None
+    if settings.role == 'api':
+        return
+
+    app.state.event_callback.start()
+    if settings.leader_election_enabled:
+        app.state.leader_election = LeaderElection(
+            redis=redis,
+            key=f"{settings.cache_prefix}gateway-leader",
+            on_elected=__start_gateway,
+            on_demoted=__stop_gateway,
+            lease=settings.leader_lease,
+            heartbeat_interval=settings.leader_heartbeat_interval
+        )
+        app.state.leader_election.start()
+        return
+
+    # requests are queued right away, the worker waits for each account to be ready
+    await __start_gateway()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    if app.state.discord_start_task:
-        app.state.discord_start_task.cancel()
-
-    discord_user_client: DiscordUserClient = app.state.discord_user_client
-    if not discord_user_client.is_closed():
-        await discord_user_client.close()
+    leader_election: Optional[LeaderElection] = app.state.leader_election
+    if leader_election:
+        # steps down, which stops the gateway
+        await leader_election.close()
+    await __stop_gateway()
+
+    event_callback: EventCallback = app.state.event_callback
+    await event_callback.close()
 
     cache: Cache = app.state.cache
     await cache.close()
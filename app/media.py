@@ -0,0 +1,129 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+from app.action_queue import QueuedFile
+from app.media_probe import MediaInfo, MediaProbeError, probe_path
+from app.schema import MediaApiError, VideoLength
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # only needed by MediaPreprocessor
+    Image = None
+    ImageOps = None
+
+# longest side DomoAI works with for every command, larger images are downsampled by DomoAI anyway
+IMAGE_MAX_SIDE = 2048
+
+VIDEO_LENGTH_SECONDS: Dict[VideoLength, float] = {
+    VideoLength.LENGTH_3S: 3,
+    VideoLength.LENGTH_5S: 5,
+    VideoLength.LENGTH_10S: 10,
+    VideoLength.LENGTH_20S: 20,
+}
+
+
+class MediaRejectedError(Exception):
+    def __init__(self, field: str, code: MediaApiError, reason: str):
+        super().__init__(f"{field}: {reason}")
+        self.field = field
+        self.code = code
+        self.reason = reason
+
+
+class MediaInspector:
+    """
+    Validates spooled uploads from their headers before they are queued.
+
+    Files of a format the prober doesn't know are let through, DomoAI has the last word on them.
+    """
+
+    def __init__(self, max_upload_bytes: Optional[int] = None, video_max_side: Optional[int] = None):
+        self.max_upload_bytes = max_upload_bytes
+        self.video_max_side = video_max_side
+
+    async def inspect(
+            self,
+            field: str,
+            file: QueuedFile,
+            video_length: Optional[VideoLength] = None
+    ) -> Optional[MediaInfo]:
+        try:
+            info = await asyncio.to_thread(probe_path, file.path)
+        except MediaProbeError as e:
+            raise MediaRejectedError(field, MediaApiError.UNREADABLE_MEDIA, str(e)) from e
+        if info is None:
+            return None
+        if field == 'video':
+            if info.kind != 'video':
+                raise MediaRejectedError(field, MediaApiError.VIDEO_EXPECTED, f"got a {info.format} image")
+            if video_length and info.duration is not None and info.duration < VIDEO_LENGTH_SECONDS[video_length]:
+                raise MediaRejectedError(
+                    field,
+                    MediaApiError.VIDEO_TOO_SHORT,
+                    f"video is {info.duration:.1f}s, shorter than the requested {video_length.value}"
+                )
+            if self.video_max_side and max(info.width or 0, info.height or 0) > self.video_max_side:
+                raise MediaRejectedError(
+                    field,
+                    MediaApiError.RESOLUTION_TOO_LARGE,
+                    f"video is {info.width}x{info.height}, the longest side may be {self.video_max_side}"
+                )
+        elif info.kind != 'image':
+            raise MediaRejectedError(field, MediaApiError.IMAGE_EXPECTED, f"got a {info.format} video")
+        return info
+
+    def check_size(self, field: str, file: QueuedFile):
+        size = os.path.getsize(file.path)
+        if self.max_upload_bytes and size > self.max_upload_bytes:
+            raise MediaRejectedError(
+                field,
+                MediaApiError.FILE_TOO_LARGE,
+                f"{size} bytes, more than the {self.max_upload_bytes} bytes allowed"
+            )
+
+
+class MediaPreprocessor:
+    """
+    Shrinks images before they are queued, needs Pillow.
+
+    Images larger than DomoAI works with are downsampled, and images above ``image_reencode_bytes``
+    re-encoded (JPEG, or PNG when they have transparency).
+    """
+
+    def __init__(
+            self,
+            image_reencode_bytes: int = 2 * 1024 * 1024,
+            jpeg_quality: int = 90
+    ):
+        self.image_reencode_bytes = image_reencode_bytes
+        self.jpeg_quality = jpeg_quality
+        if Image is None:
+            raise RuntimeError("MEDIA_PREPROCESSING_ENABLED needs Pillow, `pip install pillow`")
+
+    async def prepare_image(self, field: str, file: QueuedFile):
+        try:
+            await asyncio.to_thread(self.__shrink_image, file, IMAGE_MAX_SIDE)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise MediaRejectedError(field, MediaApiError.UNREADABLE_MEDIA, "not a readable image") from e
+
+    def __shrink_image(self, file: QueuedFile, max_side: int):
+        with Image.open(file.path) as image:
+            resize = max(image.size) > max_side
+            if not resize and os.path.getsize(file.path) <= self.image_reencode_bytes:
+                return
+            # re-encoding drops the EXIF orientation, apply it to the pixels
+            image = ImageOps.exif_transpose(image)
+            if resize:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+            if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                extension, options = 'png', dict(format='PNG', optimize=True)
+            else:
+                image = image.convert('RGB')
+                extension, options = 'jpg', dict(format='JPEG', quality=self.jpeg_quality, optimize=True)
+            tmp_path = f"{file.path}.{extension}"
+            image.save(tmp_path, **options)
+        os.replace(tmp_path, file.path)
+        name, _ = os.path.splitext(file.filename or 'image')
+        file.filename = f"{name}.{extension}"
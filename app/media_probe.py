@@ -0,0 +1,240 @@
+"""
+Header-only probing of the media formats we accept, without ffmpeg.
+
+Only box / segment / element headers are read and everything else is skipped with ``seek``, so probing
+a spooled upload touches a few KB even when the MP4 ``moov`` box sits at the end of the file.
+"""
+import struct
+from typing import BinaryIO, Optional, Tuple
+
+from pydantic import BaseModel
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SOI = b'\xff\xd8'
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+# JPEG start-of-frame markers carry the dimensions, C4 / C8 / CC are not frames
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers without a length
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8, *range(0xD0, 0xD8)}
+
+# ISO BMFF boxes holding boxes we want, anything else is skipped
+MP4_CONTAINER_BOXES = {b'moov', b'trak'}
+
+# Matroska / WebM element ids
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACK_ENTRY = 0xAE
+EBML_VIDEO = 0xE0
+EBML_PIXEL_WIDTH = 0xB0
+EBML_PIXEL_HEIGHT = 0xBA
+EBML_CLUSTER = 0x1F43B675
+EBML_MASTER_ELEMENTS = {EBML_SEGMENT, EBML_INFO, EBML_TRACKS, EBML_TRACK_ENTRY, EBML_VIDEO}
+
+# guards against corrupt or hostile files
+MAX_ELEMENTS = 4096
+
+
+class MediaProbeError(Exception):
+    pass
+
+
+class MediaInfo(BaseModel):
+    # image or video
+    kind: str
+    # png, jpeg, mp4 or webm
+    format: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # seconds, videos only, None if the container doesn't say (e.g. live recorded WebM)
+    duration: Optional[float] = None
+
+
+def __check_within(f: BinaryIO, size: int, file_size: int):
+    # sizes come from the file itself, never read or seek beyond its end on their word
+    if size < 0 or f.tell() + size > file_size:
+        raise MediaProbeError('size beyond the end of file')
+
+
+def __read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise MediaProbeError('unexpected end of file')
+    return data
+
+
+def __probe_png(f: BinaryIO) -> MediaInfo:
+    # the IHDR chunk always comes first
+    length, chunk_type, width, height = struct.unpack('>I4sII', __read_exact(f, 16))
+    if chunk_type != b'IHDR':
+        raise MediaProbeError('PNG without IHDR')
+    return MediaInfo(kind='image', format='png', width=width, height=height)
+
+
+def __probe_jpeg(f: BinaryIO) -> MediaInfo:
+    for _ in range(MAX_ELEMENTS):
+        if __read_exact(f, 1) != b'\xff':
+            raise MediaProbeError('JPEG marker expected')
+        marker = __read_exact(f, 1)[0]
+        while marker == 0xFF:
+            marker = __read_exact(f, 1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        length = struct.unpack('>H', __read_exact(f, 2))[0]
+        if length < 2:
+            raise MediaProbeError('invalid JPEG segment length')
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack('>BHH', __read_exact(f, 5))
+            return MediaInfo(kind='image', format='jpeg', width=width, height=height)
+        if marker == 0xDA:
+            break
+        f.seek(length - 2, 1)
+    raise MediaProbeError('JPEG without frame header')
+
+
+def __iter_mp4_boxes(f: BinaryIO, end: Optional[int], file_size: int, budget: list):
+    while end is None or f.tell() < end:
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise MediaProbeError('too many MP4 boxes')
+        start = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        if size == 1:
+            size = struct.unpack('>Q', __read_exact(f, 8))[0]
+        elif size == 0:
+            # runs to the end of the file
+            size = file_size - start
+        if size < 8:
+            raise MediaProbeError('invalid MP4 box size')
+        if start + size > file_size:
+            raise MediaProbeError('MP4 box beyond the end of file')
+        yield box_type, start + size
+        f.seek(start + size)
+
+
+def __walk_mp4(f: BinaryIO, info: MediaInfo, end: Optional[int], file_size: int, budget: list):
+    for box_type, box_end in __iter_mp4_boxes(f, end=end, file_size=file_size, budget=budget):
+        if box_type == b'mvhd':
+            version = __read_exact(f, 4)[0]
+            if version == 1:
+                timescale, duration = struct.unpack('>16xIQ', __read_exact(f, 28))
+            else:
+                timescale, duration = struct.unpack('>8xII', __read_exact(f, 16))
+            if timescale:
+                info.duration = duration / timescale
+        elif box_type == b'tkhd' and info.width is None:
+            version = __read_exact(f, 4)[0]
+            # skip times, track id and duration, then reserved, layer, group, volume and matrix
+            f.seek((32 if version == 1 else 20) + 52, 1)
+            width, height = struct.unpack('>II', __read_exact(f, 8))
+            # 16.16 fixed point, audio tracks have no size
+            if width and height:
+                info.width, info.height = width >> 16, height >> 16
+        elif box_type in MP4_CONTAINER_BOXES:
+            __walk_mp4(f, info=info, end=box_end, file_size=file_size, budget=budget)
+            if box_type == b'moov':
+                return
+
+
+def __probe_mp4(f: BinaryIO, file_size: int) -> MediaInfo:
+    info = MediaInfo(kind='video', format='mp4')
+    __walk_mp4(f, info=info, end=None, file_size=file_size, budget=[MAX_ELEMENTS])
+    return info
+
+
+def __read_ebml_vint(f: BinaryIO, keep_marker: bool) -> Tuple[int, bool]:
+    first = __read_exact(f, 1)[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise MediaProbeError('invalid EBML number')
+    value = first if keep_marker else first & (mask - 1)
+    for byte in __read_exact(f, length - 1):
+        value = (value << 8) | byte
+    unknown_size = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, unknown_size
+
+
+def __read_ebml_uint(f: BinaryIO, size: int) -> int:
+    if size > 8:
+        raise MediaProbeError('EBML unsigned integer longer than 8 bytes')
+    return int.from_bytes(__read_exact(f, size), 'big')
+
+
+def __probe_webm(f: BinaryIO, file_size: int) -> MediaInfo:
+    info = MediaInfo(kind='video', format='webm')
+    # skip the EBML header
+    f.seek(4)
+    header_size, _ = __read_ebml_vint(f, keep_marker=False)
+    __check_within(f, header_size, file_size)
+    f.seek(header_size, 1)
+
+    timecode_scale = 1000000
+    duration = None
+    for _ in range(MAX_ELEMENTS):
+        try:
+            element_id, _ = __read_ebml_vint(f, keep_marker=True)
+            size, unknown_size = __read_ebml_vint(f, keep_marker=False)
+        except MediaProbeError:
+            break
+        if element_id == EBML_CLUSTER:
+            # media data, all headers we need come before it
+            break
+        if element_id in EBML_MASTER_ELEMENTS:
+            # a master of unknown size (e.g. a live recorded Segment) runs to the end of the file
+            if not unknown_size:
+                __check_within(f, size, file_size)
+            continue
+        if unknown_size:
+            break
+        __check_within(f, size, file_size)
+        if element_id == EBML_TIMECODE_SCALE:
+            timecode_scale = __read_ebml_uint(f, size)
+        elif element_id == EBML_DURATION:
+            if size not in (4, 8):
+                raise MediaProbeError('EBML float of invalid size')
+            duration = struct.unpack('>f' if size == 4 else '>d', __read_exact(f, size))[0]
+        elif element_id == EBML_PIXEL_WIDTH and info.width is None:
+            info.width = __read_ebml_uint(f, size)
+        elif element_id == EBML_PIXEL_HEIGHT and info.height is None:
+            info.height = __read_ebml_uint(f, size)
+        else:
+            f.seek(size, 1)
+    if duration is not None:
+        info.duration = duration * timecode_scale / 1e9
+    return info
+
+
+def probe(f: BinaryIO) -> Optional[MediaInfo]:
+    """Probe an open binary file, None if it is none of the formats we know."""
+    file_size = f.seek(0, 2)
+    f.seek(0)
+    head = f.read(12)
+    f.seek(0)
+    try:
+        if head.startswith(PNG_SIGNATURE):
+            f.seek(len(PNG_SIGNATURE))
+            return __probe_png(f)
+        if head.startswith(JPEG_SOI):
+            f.seek(len(JPEG_SOI))
+            return __probe_jpeg(f)
+        if head[4:8] == b'ftyp':
+            return __probe_mp4(f, file_size=file_size)
+        if head.startswith(EBML_MAGIC):
+            return __probe_webm(f, file_size=file_size)
+    except (MediaProbeError, struct.error, OverflowError) as e:
+        raise MediaProbeError(f'corrupt media: {e}') from e
+    return None
+
+
+def probe_path(path: str) -> Optional[MediaInfo]:
+    with open(path, 'rb') as f:
+        return probe(f)
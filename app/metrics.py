@@ -0,0 +1,122 @@
+"""
+Prometheus metrics, exposed at ``/metrics``.
+
+Stage latencies are histograms labelled by command and mode. Gauges are set from the live objects
+when ``/metrics`` is scraped.
+"""
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import REGISTRY, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from app.schema import Mode, TaskCommand
+
+# from sub-second API work up to hour long video generations
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# api_upload: request received until the task is queued, reading, probing and preprocessing the uploads
+# queue_wait: task queued until a worker dispatches it to an account
+# discord_upload: uploading one file to discord, uploads reused from the upload cache are not timed
+# dispatch: sending the slash command or button click until discord acknowledges the interaction
+# generating_message: interaction acknowledged until DomoAI replies with the message of the task
+# domoai_queue: task submitted until DomoAI starts generating it
+# generation: DomoAI started generating until the result is in
+# total: task queued until the result is in
+# webhook: event enqueued until the callback url accepted it, retries included
+TASK_STAGE_SECONDS = Histogram(
+    'domoai_task_stage_seconds',
+    'Seconds spent in each stage of a task',
+    ['stage', 'command', 'mode'],
+    buckets=STAGE_BUCKETS
+)
+
+IN_FLIGHT_TASKS = Gauge('domoai_in_flight_tasks', 'Tasks submitted or running per account', ['account'])
+ACTION_QUEUE_DEPTH = Gauge('domoai_action_queue_depth', 'Actions waiting for a worker')
+EVENT_CALLBACK_BACKLOG = Gauge('domoai_event_callback_backlog', 'Events waiting in the event callback outbox')
+EVENT_CALLBACK_DEAD_LETTERS = Gauge('domoai_event_callback_dead_letters', 'Events which could not be delivered')
+
+# command and mode of the action a worker is submitting, labels the stages timed inside DiscordUserClient
+submit_labels: ContextVar[Tuple[Optional[TaskCommand], Optional[Mode]]] = ContextVar(
+    'submit_labels',
+    default=(None, None)
+)
+
+
+def observe_stage(stage: str, seconds: float, command: Optional[TaskCommand], mode: Optional[Mode] = None):
+    TASK_STAGE_SECONDS.labels(
+        stage=stage,
+        command=command.value if command else 'unknown',
+        mode=mode.value if mode else 'none'
+    ).observe(max(seconds, 0))
+
+
+def observe_submit_stage(stage: str, seconds: float):
+    command, mode = submit_labels.get()
+    observe_stage(stage=stage, seconds=seconds, command=command, mode=mode)
+
+
+class CacheStatsCollector:
+    """Hit and miss totals of the in-process caches, which count them themselves, exported as counters."""
+
+    def __init__(self):
+        # cache -> (hits, misses)
+        self.stats: Dict[str, Tuple[int, int]] = {}
+
+    def collect(self):
+        hits = CounterMetricFamily('domoai_cache_hits', 'Hits of an in-process cache', labels=['cache'])
+        misses = CounterMetricFamily('domoai_cache_misses', 'Misses of an in-process cache', labels=['cache'])
+        ratio = GaugeMetricFamily(
+            'domoai_cache_hit_ratio',
+            'Share of the reads of an in-process cache which hit, since startup',
+            labels=['cache']
+        )
+        for cache, (cache_hits, cache_misses) in self.stats.items():
+            hits.add_metric([cache], cache_hits)
+            misses.add_metric([cache], cache_misses)
+            ratio.add_metric([cache], cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses else 0)
+        yield hits
+        yield misses
+        yield ratio
+
+
+CACHE_STATS = CacheStatsCollector()
+REGISTRY.register(CACHE_STATS)
+
+
+def set_cache_stats(cache: str, hits: int, misses: int):
+    CACHE_STATS.stats[cache] = (hits, misses)
+
+
+class GatewayEventStatsCollector:
+    """Message edits and events each account counts itself before doing any I/O, exported as counters."""
+
+    def __init__(self):
+        # account -> (handled edits, skipped edits, dropped events)
+        self.stats: Dict[str, Tuple[int, int, int]] = {}
+
+    def collect(self):
+        edits = CounterMetricFamily(
+            'domoai_gateway_message_edits',
+            'Edits of DomoAI messages, handled for an in-flight task or skipped',
+            labels=['account', 'outcome']
+        )
+        dropped = CounterMetricFamily(
+            'domoai_gateway_dropped_events',
+            'Gateway events of other channels dropped before parsing, lean mode only',
+            labels=['account']
+        )
+        for account, (handled_edits, skipped_edits, dropped_events) in self.stats.items():
+            edits.add_metric([account, 'handled'], handled_edits)
+            edits.add_metric([account, 'skipped'], skipped_edits)
+            dropped.add_metric([account], dropped_events)
+        yield edits
+        yield dropped
+
+
+GATEWAY_EVENT_STATS = GatewayEventStatsCollector()
+REGISTRY.register(GATEWAY_EVENT_STATS)
+
+
+def set_gateway_event_stats(stats: Dict[str, Tuple[int, int, int]]):
+    GATEWAY_EVENT_STATS.stats = stats
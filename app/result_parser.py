@@ -0,0 +1,162 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+import discord
+from pydantic import BaseModel
+
+from app.schema import TaskAsset, TaskCommand
+
+# "/gen ..." and "/real ..." carry the prompt in the title, the others are exact
+EMBED_TITLE_PATTERN = re.compile(r'^/(?:(gen|real)|(animate|video|move)$)')
+VIDEO_URL_PATTERN = re.compile(r'After:.*?(https:.*)')
+MOVE_URL_PATTERN = re.compile(r'Result:.*?(https:.*)')
+PROGRESS_PATTERN = re.compile(r'(\d{1,3})(?:\.\d+)?\s*%')
+QUEUE_POSITION_PATTERN = re.compile(r'queue[^0-9\n]{0,24}(\d+)', re.IGNORECASE)
+# DomoAI error replies: the command embed with a description starting with one of these, or an embed
+# of its own with one of ERROR_TITLES as title
+ERROR_DESCRIPTION_PATTERN = re.compile(
+    r'^(?:generation failed|failed to generate|job failed|error)\b',
+    re.IGNORECASE
+)
+ERROR_TITLES = {'error', 'generation failed', 'job failed', 'content policy violation'}
+ERROR_MAX_LENGTH = 200
+
+EMBED_TITLE_COMMANDS = {
+    'gen': TaskCommand.GEN,
+    'real': TaskCommand.REAL,
+    'animate': TaskCommand.ANIMATE,
+    'video': TaskCommand.VIDEO,
+    'move': TaskCommand.MOVE,
+}
+
+
+class ResultSpec(NamedTuple):
+    # whether the result is stored in TaskCacheData.images or TaskCacheData.videos
+    is_image: bool
+    # where to find the result url when the message has no attachment
+    content_url_pattern: Optional[Pattern]
+    with_buttons: bool
+
+
+RESULT_SPECS: Dict[TaskCommand, ResultSpec] = {
+    TaskCommand.GEN: ResultSpec(is_image=True, content_url_pattern=None, with_buttons=True),
+    TaskCommand.REAL: ResultSpec(is_image=True, content_url_pattern=None, with_buttons=True),
+    TaskCommand.ANIMATE: ResultSpec(is_image=False, content_url_pattern=None, with_buttons=False),
+    TaskCommand.VIDEO: ResultSpec(is_image=False, content_url_pattern=VIDEO_URL_PATTERN, with_buttons=False),
+    TaskCommand.MOVE: ResultSpec(is_image=False, content_url_pattern=MOVE_URL_PATTERN, with_buttons=False),
+}
+
+
+class ParsedResult(BaseModel):
+    command: TaskCommand
+    images: Optional[List[TaskAsset]] = None
+    videos: Optional[List[TaskAsset]] = None
+    upscale_custom_ids: Optional[Dict[str, str]] = None
+    vary_custom_ids: Optional[Dict[str, str]] = None
+
+
+class ParsedProgress(BaseModel):
+    command: TaskCommand
+    progress_percent: Optional[int] = None
+    queue_position: Optional[int] = None
+    started: bool = False
+
+
+def detect_command(message: discord.Message) -> Optional[TaskCommand]:
+    if message.embeds:
+        title = message.embeds[0].title
+        if not title:
+            return None
+        match = EMBED_TITLE_PATTERN.match(title)
+        if not match:
+            return None
+        return EMBED_TITLE_COMMANDS[match.group(1) or match.group(2)]
+    content = message.content
+    if 'After:' in content and 'Before:' in content:
+        return TaskCommand.VIDEO
+    if 'Result:' in content and 'Image:' in content and 'Video:' in content:
+        return TaskCommand.MOVE
+    return None
+
+
+def parse_buttons(message: discord.Message) -> Tuple[Dict[str, str], Dict[str, str]]:
+    upscale_custom_ids = {}
+    vary_custom_ids = {}
+    for row in message.components:
+        for component in row.children:
+            label = component.label
+            if component.disabled or not label or not component.custom_id:
+                continue
+            if label[0] == 'U':
+                upscale_custom_ids[label] = component.custom_id
+            elif label.startswith('Vary'):
+                vary_custom_ids['V1'] = component.custom_id
+            elif label[0] == 'V':
+                vary_custom_ids[label] = component.custom_id
+    return upscale_custom_ids, vary_custom_ids
+
+
+def parse_result(message: discord.Message) -> Optional[ParsedResult]:
+    """Parse a finished DomoAI result message, None if the message is not (yet) a result."""
+    command = detect_command(message)
+    if command is None:
+        return None
+    spec = RESULT_SPECS[command]
+
+    if message.attachments:
+        asset = TaskAsset.from_attachment(message.attachments[0])
+    elif spec.content_url_pattern is not None:
+        match = spec.content_url_pattern.search(message.content)
+        if not match:
+            return None
+        url = match.group(1)
+        asset = TaskAsset(url=url, proxy_url=url)
+    else:
+        return None
+
+    result = ParsedResult(command=command)
+    if spec.is_image:
+        result.images = [asset]
+    else:
+        result.videos = [asset]
+    if spec.with_buttons:
+        result.upscale_custom_ids, result.vary_custom_ids = parse_buttons(message)
+    return result
+
+
+def parse_progress(message: discord.Message) -> Optional[ParsedProgress]:
+    """Parse queue / progress information from an intermediate edit of a DomoAI message."""
+    command = detect_command(message)
+    if command is None:
+        return None
+    if message.embeds:
+        text = message.embeds[0].description or ''
+    else:
+        text = message.content
+    progress = ParsedProgress(command=command)
+    match = PROGRESS_PATTERN.search(text)
+    if match:
+        progress.progress_percent = min(int(match.group(1)), 100)
+    match = QUEUE_POSITION_PATTERN.search(text)
+    if match:
+        progress.queue_position = int(match.group(1))
+    progress.started = progress.progress_percent is not None or 'Generating' in text
+    if progress.progress_percent is None and progress.queue_position is None and not progress.started:
+        return None
+    return progress
+
+
+def parse_error(message: discord.Message) -> Optional[str]:
+    """Return the text of a DomoAI error reply (failed, moderated, rejected job), None otherwise."""
+    # errors always come as an embed, message content holds mentions and result urls
+    if not message.embeds:
+        return None
+    embed = message.embeds[0]
+    description = (embed.description or '').strip()
+    if ERROR_DESCRIPTION_PATTERN.match(description):
+        return description[:ERROR_MAX_LENGTH]
+    # the title of a command embed carries the prompt, an error embed has its own title
+    title = (embed.title or '').strip()
+    if title.lower() in ERROR_TITLES and detect_command(message) is None:
+        return f'{title}\n{description}'.strip()[:ERROR_MAX_LENGTH]
+    return None
@@ -4,7 +4,7 @@ import enum
 from typing import Optional, List, Dict
 
 import discord
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class Mode(enum.Enum):
@@ -48,10 +48,19 @@ class VideoReferMode(enum.Enum):
 
 
 class VideoApiError(enum.Enum):
-    VIDEO_MODEL_ERROR: 10000
-    NOT_ALLOW_REFER: 10001
-    NOT_ALLOW_LIP_SYNC: 10002
-    MODEL_NEED_REFERENCE_IMAGE: 10003
+    VIDEO_MODEL_ERROR = 10000
+    NOT_ALLOW_REFER = 10001
+    NOT_ALLOW_LIP_SYNC = 10002
+    MODEL_NEED_REFERENCE_IMAGE = 10003
+
+
+class MediaApiError(enum.Enum):
+    UNREADABLE_MEDIA = 10100
+    IMAGE_EXPECTED = 10101
+    VIDEO_EXPECTED = 10102
+    FILE_TOO_LARGE = 10103
+    VIDEO_TOO_SHORT = 10104
+    RESOLUTION_TOO_LARGE = 10105
 
 
 class VideoKey(enum.Enum):
@@ -103,8 +112,17 @@ class TaskAsset(BaseModel):
 
 
 class TaskStatus(enum.Enum):
+    QUEUED = "QUEUED"
+    SUBMITTED = "SUBMITTED"
     RUNNING = "RUNNING"
     SUCCESS = "SUCCESS"
+    FAILED = "FAILED"
+    # no result within the deadline of the command
+    TIMEOUT = "TIMEOUT"
+
+    @property
+    def is_finished(self) -> bool:
+        return self in (TaskStatus.SUCCESS, TaskStatus.FAILED, TaskStatus.TIMEOUT)
 
 
 class TaskCommand(enum.Enum):
@@ -117,32 +135,49 @@ class TaskCommand(enum.Enum):
 
 class TaskCacheData(BaseModel):
     command: TaskCommand
-    channel_id: str
-    guild_id: Optional[str]
-    message_id: str
+    channel_id: Optional[str] = None
+    guild_id: Optional[str] = None
+    message_id: Optional[str] = None
     images: Optional[List[TaskAsset]] = None
     videos: Optional[List[TaskAsset]] = None
     status: TaskStatus
     upscale_custom_ids: Optional[Dict[str, str]] = None
     vary_custom_ids: Optional[Dict[str, str]] = None
+    account_id: Optional[str] = None
+    error: Optional[str] = None
+    progress_percent: Optional[int] = None
+    queue_position: Optional[int] = None
+    # unix timestamps of when the task was queued, sent to discord and picked up by DomoAI
+    created_at: Optional[float] = None
+    submitted_at: Optional[float] = None
+    started_at: Optional[float] = None
+    # mode requested for the task, None for follow-ups and records written before it was tracked
+    mode: Optional[Mode] = None
 
 
 class CreateTaskOut(BaseModel):
     success: bool
     task_id: str
-    message_id: str
+    message_id: Optional[str] = None
+    status: TaskStatus
 
 
 class TaskStateOut(BaseModel):
     command: TaskCommand
-    channel_id: str
-    guild_id: Optional[str]
-    message_id: str
+    channel_id: Optional[str] = None
+    guild_id: Optional[str] = None
+    message_id: Optional[str] = None
     images: Optional[List[TaskAsset]] = None
     videos: Optional[List[TaskAsset]] = None
     status: TaskStatus
     upscale_indices: Optional[List[int]] = None
     vary_indices: Optional[List[int]] = None
+    error: Optional[str] = None
+    progress_percent: Optional[int] = None
+    queue_position: Optional[int] = None
+    created_at: Optional[float] = None
+    submitted_at: Optional[float] = None
+    started_at: Optional[float] = None
 
     @staticmethod
     def from_cache_data(data: TaskCacheData) -> TaskStateOut:
@@ -186,5 +221,20 @@ class TaskStateOut(BaseModel):
             videos=data.videos,
             status=data.status,
             upscale_indices=upscale_indices,
-            vary_indices=vary_indices
+            vary_indices=vary_indices,
+            error=data.error,
+            progress_percent=data.progress_percent,
+            queue_position=data.queue_position,
+            created_at=data.created_at,
+            submitted_at=data.submitted_at,
+            started_at=data.started_at
         )
+
+
+class TaskDataBatchIn(BaseModel):
+    task_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+
+class TaskDataBatchOut(BaseModel):
+    tasks: Dict[str, TaskStateOut]
+    missing: List[str]
@@ -1,9 +1,18 @@
 import os
 from functools import lru_cache
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from app.schema import TaskCommand
+
+
+class DiscordAccount(BaseModel):
+    token: str
+    guild_id: int
+    channel_id: int
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -15,15 +24,102 @@ class Settings(BaseSettings):
     discord_guild_id: int
     discord_channel_id: int
 
+    # JSON list of additional accounts, e.g. [{"token": "...", "guild_id": 1, "channel_id": 2}]
+    discord_extra_accounts: List[DiscordAccount] = []
+
     domoai_application_id: int = 1153984868804468756
 
     redis_uri: Optional[str] = None
 
+    # all: one process serves the API and runs the discord gateway
+    # gateway / api: one gateway process drains a redis action queue filled by any number of api workers,
+    # both need redis_uri and near_cache_enabled
+    role: Literal['all', 'gateway', 'api'] = 'all'
+    # with several gateway replicas only the holder of a redis lease connects to discord, needs redis_uri
+    leader_election_enabled: bool = False
+    leader_lease: float = 10
+    leader_heartbeat_interval: float = 3
+
     event_callback_url: Optional[str] = None
+    event_callback_workers: int = 4
+    event_callback_outbox_size: int = 1000
+    event_callback_max_attempts: int = 5
+    # needs the h2 package, `pip install httpx[http2]`
+    event_callback_http2: bool = False
 
     cache_prefix: str = 'domoai:'
+    # storage format of task records, every codec still reads records written by the others
+    cache_codec: Literal['json', 'msgpack'] = 'json'
+
+    # in-process cache of task data in front of redis, kept in sync across replicas with pub/sub
+    near_cache_enabled: bool = True
+    near_cache_max_entries: int = 10000
+    near_cache_running_ttl: int = 2
+
+    # retention of task records in seconds, 0 keeps them forever
+    task_running_ttl: int = 2 * 24 * 3600
+    task_finished_ttl: int = 30 * 24 * 3600
+
+    # only used when redis_uri is not set
+    memory_cache_max_entries: Optional[int] = 100000
+    memory_cache_max_bytes: Optional[int] = None
+    memory_cache_sweep_interval: Optional[float] = 60
 
     api_auth_token: Optional[str] = None
+    # bearer token required by GET /metrics, which is open when unset (like GET /health)
+    metrics_auth_token: Optional[str] = None
+
+    action_queue_max_size: int = 1000
+    # tasks one account has submitted or running on DomoAI at a time, further actions wait in the queue
+    account_max_concurrent_submissions: int = 3
+    # seconds a dispatched action waits for its account to connect and load its slash commands before failing
+    account_ready_timeout: float = 120
+    # minimum seconds between two progress writes of the same task
+    task_progress_min_interval: float = 3
+
+    # unfinished tasks past their deadline in seconds are moved to TIMEOUT, e.g. {"VIDEO": 5400}
+    task_deadlines: Dict[TaskCommand, int] = {}
+    task_queued_deadline: int = 60 * 60
+    task_watchdog_interval: float = 60
+
+    # catch-up of in-flight messages after a reconnect or restart
+    reconcile_request_interval: float = 1
+    reconcile_max_history: int = 2000
+
+    # slash commands are loaded from the cache at startup and refreshed from discord once connected,
+    # seconds to keep them, 0 keeps them forever
+    slash_command_cache_ttl: int = 7 * 24 * 3600
+
+    # lean gateway: no message / member caches, no member chunking, only our guild subscribed, and
+    # events of other channels dropped before they are parsed
+    gateway_lean_mode: bool = False
+    # share of the messages seen in the channel which are logged, 0 to 1
+    gateway_log_sample_rate: float = 1
+
+    # files uploaded to discord are reused for identical content for this many seconds
+    upload_cache_ttl: int = 3600
+    upload_cache_max_entries: int = 1000
+    # where uploads wait for their action, the system temp dir by default
+    upload_spool_dir: Optional[str] = None
+
+    # uploads are always checked from their headers, these limits are off unless set,
+    # media_max_upload_bytes is required with a shared queue since queued uploads are kept in redis
+    media_max_upload_bytes: Optional[int] = None
+    media_video_max_side: Optional[int] = None
+    # downsample / re-encode images before they are queued, needs Pillow, `pip install pillow`
+    media_preprocessing_enabled: bool = False
+    media_image_reencode_bytes: int = 2 * 1024 * 1024
+    media_jpeg_quality: int = 90
+
+    def get_discord_accounts(self) -> List[DiscordAccount]:
+        return [
+            DiscordAccount(
+                token=self.discord_token,
+                guild_id=self.discord_guild_id,
+                channel_id=self.discord_channel_id
+            ),
+            *self.discord_extra_accounts
+        ]
 
 
 @lru_cache()
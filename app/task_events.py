@@ -0,0 +1,42 @@
+import asyncio
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from app.schema import TaskCacheData
+
+TaskEvent = Tuple[str, TaskCacheData]
+
+
+class TaskEventHub:
+    """
+    In-process fan-out of task state changes, used by long-poll and SSE clients instead of polling the cache.
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        # key None receives the events of every task
+        self.__subscribers: Dict[Optional[str], Set[asyncio.Queue]] = {}
+
+    def publish(self, task_id: str, data: TaskCacheData):
+        for key in (task_id, None):
+            for queue in self.__subscribers.get(key, ()):
+                if queue.full():
+                    # slow consumer, drop the oldest event, the newest state is what matters
+                    queue.get_nowait()
+                queue.put_nowait((task_id, data))
+
+    def has_subscribers(self, task_id: str) -> bool:
+        return bool(self.__subscribers.get(task_id) or self.__subscribers.get(None))
+
+    @contextmanager
+    def subscribe(self, task_id: Optional[str] = None) -> Iterator['asyncio.Queue[TaskEvent]']:
+        queue: asyncio.Queue[TaskEvent] = asyncio.Queue(maxsize=self.queue_size)
+        self.__subscribers.setdefault(task_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self.__subscribers.get(task_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self.__subscribers[task_id]
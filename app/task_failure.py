@@ -0,0 +1,33 @@
+from typing import Optional
+
+from app.cache import Cache
+from app.event_callback import EventCallback
+from app.schema import TaskCacheData, TaskCommand, TaskStatus
+
+
+async def fail_task(
+        cache: Cache,
+        event_callback: EventCallback,
+        task_id: str,
+        error: str,
+        status: TaskStatus = TaskStatus.FAILED,
+        command: Optional[TaskCommand] = None
+) -> Optional[TaskCacheData]:
+    """
+    Move an unfinished task to FAILED (or TIMEOUT) and send TASK_FAILED.
+
+    Returns None and writes nothing if the task has finished in the meantime, or if its record is gone
+    and no ``command`` is given to recreate it.
+    """
+    data = await cache.get_task_data_by_id(task_id=task_id)
+    if data is None:
+        if command is None:
+            return None
+        data = TaskCacheData(command=command, status=status)
+    elif data.status.is_finished:
+        return None
+    data.status = status
+    data.error = error
+    await cache.set_task_id2data(task_id=task_id, data=data)
+    await event_callback.send_task_failed(task_id=task_id, data=data)
+    return data
@@ -0,0 +1,110 @@
+import asyncio
+import time
+import traceback
+from typing import Dict, Optional
+
+from app.account_pool import DiscordUserClientPool
+from app.cache import Cache
+from app.event_callback import EventCallback
+from app.schema import TaskCacheData, TaskCommand, TaskStatus
+from app.task_failure import fail_task
+
+# seconds a submitted task may take before it is moved to TIMEOUT
+DEFAULT_TASK_DEADLINES: Dict[TaskCommand, int] = {
+    TaskCommand.GEN: 15 * 60,
+    TaskCommand.REAL: 15 * 60,
+    TaskCommand.ANIMATE: 30 * 60,
+    TaskCommand.VIDEO: 60 * 60,
+    TaskCommand.MOVE: 60 * 60,
+}
+
+
+class TaskWatchdog:
+    """
+    Periodically sweeps the unfinished tasks and moves the ones past their deadline to TIMEOUT.
+
+    QUEUED tasks are measured from ``created_at`` against ``queued_deadline``, SUBMITTED and RUNNING
+    tasks from ``submitted_at`` against the deadline of their command.
+    """
+
+    def __init__(
+            self,
+            cache: Cache,
+            pool: DiscordUserClientPool,
+            event_callback: EventCallback,
+            deadlines: Optional[Dict[TaskCommand, int]] = None,
+            queued_deadline: int = 60 * 60,
+            interval: float = 60
+    ):
+        self.cache = cache
+        self.pool = pool
+        self.event_callback = event_callback
+        self.deadlines = {**DEFAULT_TASK_DEADLINES, **(deadlines or {})}
+        self.queued_deadline = queued_deadline
+        self.interval = interval
+        self.__task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                timed_out = await self.sweep()
+                if timed_out:
+                    print(f"task watchdog, timed out tasks: {timed_out}")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    def __get_timeout(self, data: TaskCacheData) -> int:
+        if data.status == TaskStatus.QUEUED:
+            return self.queued_deadline
+        return self.deadlines[data.command]
+
+    async def sweep(self) -> int:
+        task_ids = await self.cache.get_running_task_ids()
+        if not task_ids:
+            return 0
+        now = time.time()
+        timed_out = 0
+        for task_id, data in (await self.cache.get_tasks_data_by_ids(task_ids=task_ids)).items():
+            if data is None:
+                # the record expired or was evicted, drop it from the index
+                await self.cache.remove_running_task(task_id=task_id)
+                continue
+            if data.status.is_finished:
+                continue
+            since = data.created_at if data.status == TaskStatus.QUEUED else data.submitted_at
+            if since is None:
+                # records written before tasks carried timestamps, start their clock now
+                if data.status == TaskStatus.QUEUED:
+                    data.created_at = now
+                else:
+                    data.submitted_at = now
+                await self.cache.set_task_id2data(task_id=task_id, data=data)
+                continue
+            if now - since < self.__get_timeout(data):
+                continue
+            failed = await fail_task(
+                cache=self.cache,
+                event_callback=self.event_callback,
+                task_id=task_id,
+                error=f'no result after {int(now - since)}s ({data.status.value})',
+                status=TaskStatus.TIMEOUT
+            )
+            if failed is None:
+                continue
+            if data.message_id:
+                for client in self.pool.clients:
+                    client.forget_task(message_id=data.message_id)
+            timed_out += 1
+        return timed_out
@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+from typing import Optional
+
+import discord
+
+from app.cache import MemoryCache
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadCache:
+    """
+    Files already uploaded to Discord's bucket by one account, keyed by SHA-256 of their content.
+
+    A :class:`discord.CloudFile` can be attached to any number of commands until Discord drops the
+    upload, so resubmitting the same media skips the upload. Entries expire after ``ttl`` seconds and
+    are forgotten as soon as a command using them fails.
+    """
+
+    def __init__(self, ttl: int = 3600, max_entries: int = 1000):
+        self.ttl = ttl
+        self.entries = MemoryCache(max_entries=max_entries)
+
+    @staticmethod
+    def __hash(file: discord.File) -> str:
+        sha256 = hashlib.sha256()
+        try:
+            for chunk in iter(lambda: file.fp.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        finally:
+            file.reset()
+        return sha256.hexdigest()
+
+    async def digest(self, file: discord.File) -> str:
+        return await asyncio.to_thread(self.__hash, file)
+
+    async def get(self, digest: str) -> Optional[discord.CloudFile]:
+        return await self.entries.get_value(key=digest)
+
+    async def set(self, digest: str, uploaded: discord.CloudFile):
+        await self.entries.set_value(key=digest, value=uploaded, ex=self.ttl)
+
+    async def delete(self, digest: str):
+        await self.entries.delete_value(key=digest)
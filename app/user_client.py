@@ -1,17 +1,46 @@
 import asyncio
-import re
-from typing import Dict, List, Optional
+import json
+import random
+import time
+import traceback
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import discord
-from discord import ComponentType, InteractionType, InvalidData
+from discord import ApplicationCommandType, ComponentType, InteractionType, InvalidData
 from discord.http import Route
 from discord.utils import _generate_nonce
+from tenacity import AsyncRetrying, RetryCallState, stop_after_attempt, stop_never, wait_exponential
 
 from app.cache import Cache
+from app.correlation import InteractionCorrelator
 from app.event_callback import EventCallback
+from app.metrics import observe_stage, observe_submit_stage
 from app.models import GenModel, MoveModel, VideoModel
-from app.schema import VideoReferMode, VideoLength, TaskCacheData, TaskAsset, TaskStatus, \
-    TaskCommand, AnimateIntensity, AnimateLength, Mode, VideoKey
+from app.result_parser import parse_error, parse_progress, parse_result
+from app.schema import VideoReferMode, VideoLength, TaskCacheData, TaskStatus, AnimateIntensity, AnimateLength, \
+    Mode, VideoKey
+from app.task_failure import fail_task
+from app.upload_cache import UploadCache
+
+# gateway events carrying a channel_id which lean mode drops for other channels before they are parsed
+CHANNEL_EVENTS = (
+    'MESSAGE_CREATE',
+    'MESSAGE_UPDATE',
+    'MESSAGE_DELETE',
+    'MESSAGE_DELETE_BULK',
+    'MESSAGE_ACK',
+    'MESSAGE_REACTION_ADD',
+    'MESSAGE_REACTION_REMOVE',
+    'MESSAGE_REACTION_REMOVE_ALL',
+    'MESSAGE_REACTION_REMOVE_EMOJI',
+    'TYPING_START',
+)
+
+
+class TaskProgressWrite(NamedTuple):
+    # time.monotonic() of the write
+    written_at: float
+    data: TaskCacheData
 
 
 class DiscordUserClient(discord.Client):
@@ -22,254 +51,540 @@ class DiscordUserClient(discord.Client):
             guild_id: int,
             application_id: int,
             cache: Cache,
-            event_callback_url: Optional[str],
+            event_callback: EventCallback,
+            progress_min_interval: float = 3,
+            reconcile_request_interval: float = 1,
+            reconcile_max_history: int = 2000,
+            upload_cache: Optional[UploadCache] = None,
+            command_cache_ttl: Optional[int] = 7 * 24 * 3600,
+            lean: bool = False,
+            log_sample_rate: float = 1,
             **options
     ):
+        if lean:
+            # edits arrive through on_raw_message_edit, nothing needs cached messages or members
+            options.setdefault('max_messages', None)
+            options.setdefault('member_cache_flags', discord.MemberCacheFlags.none())
+            options.setdefault('chunk_guilds_at_startup', False)
+            # only our guild is subscribed to, once ready
+            options.setdefault('guild_subscriptions', False)
         super().__init__(**options)
-        self.event_callback = EventCallback(callback_url=event_callback_url)
+        self.lean = lean
+        self.event_callback = event_callback
         self.application_id = application_id
         self.commands: Dict[str, discord.SlashCommand] = {}
+        self.command_cache_ttl = command_cache_ttl or None
+        # set once commands are loaded, from the cache or from discord
+        self.__commands_loaded = asyncio.Event()
+        # resolves the channel and refreshes the commands after READY
+        self.__metadata_task: Optional[asyncio.Task] = None
 
         self.guild_id = guild_id
         self.guild = None
 
         self.channel_id = channel_id
         self.channel = None
+        # set once guild and channel are resolved after READY
+        self.__channel_resolved = asyncio.Event()
         self.cache = cache
 
         self.bot_user_id = None
+        # uploads are bound to the account, every client has its own cache
+        self.upload_cache = upload_cache or UploadCache()
+        self.correlator = InteractionCorrelator()
+
+        # message id -> task id of tasks bound to this account which have not finished yet
+        self.in_flight_tasks: Dict[str, str] = {}
+        # message id -> record of the in-flight task as it was bound, carries its timestamps into the result
+        self.in_flight_records: Dict[str, TaskCacheData] = {}
+        # submissions dispatched to this account which are not bound to a message yet
+        self.pending_submissions = 0
+        # called when an in-flight task is forgotten, set by the pool
+        self.on_slot_freed: Optional[Callable[[], None]] = None
+
+        # message id -> last progress written to the cache, used to throttle progress writes
+        self.task_progress: Dict[str, TaskProgressWrite] = {}
+        self.progress_min_interval = progress_min_interval
+
+        self.reconcile_request_interval = reconcile_request_interval
+        self.reconcile_max_history = reconcile_max_history
+        self.__reconcile_task: Optional[asyncio.Task] = None
+
+        # edits of messages which are not in in_flight_tasks are dropped before any I/O
+        self.handled_edits = 0
+        self.skipped_edits = 0
+        # events of other channels dropped before parsing, lean mode only
+        self.dropped_events = 0
+        # share of seen messages which are logged
+        self.log_sample_rate = log_sample_rate
+        if lean:
+            self.__drop_other_channel_events()
+
+    @property
+    def account_id(self) -> Optional[str]:
+        return str(self.user.id) if self.user else None
+
+    @property
+    def in_flight_count(self) -> int:
+        return len(self.in_flight_tasks) + self.pending_submissions
 
     async def setup_hook(self):
         self.bot_user_id = self.user.id
-        self.guild = await self.fetch_guild(self.guild_id)
-        self.channel = await self.fetch_channel(self.channel_id)
-        await self.__init_slash_commands()
+        self.correlator.bot_user_id = self.user.id
+        # no discord round trips before connecting: commands come from the cache and are refreshed once
+        # ready, guild and channel come with READY
+        await self.__load_slash_commands()
+        await self.load_in_flight_tasks()
+
+    async def load_in_flight_tasks(self):
+        """Rebuild in_flight_tasks from the running tasks in the cache, e.g. after a restart."""
+        task_ids = await self.cache.get_running_task_ids()
+        if not task_ids:
+            return
+        for task_id, data in (await self.cache.get_tasks_data_by_ids(task_ids=task_ids)).items():
+            if data is None:
+                # the record expired, drop it from the index
+                await self.cache.remove_running_task(task_id=task_id)
+                continue
+            if not data.message_id:
+                continue
+            if data.account_id == self.account_id or (
+                    data.account_id is None and data.channel_id == str(self.channel_id)
+            ):
+                self.bind_task(message_id=data.message_id, task_id=task_id, data=data)
+        print(f'in flight tasks: {len(self.in_flight_tasks)}')
+
+    async def on_ready(self):
+        print(f'Logged on as {self.user}')
+        self.__schedule_metadata_refresh()
+        self.__schedule_reconcile()
+
+    async def on_resumed(self):
+        self.__schedule_reconcile()
+
+    def is_ready(self) -> bool:
+        """Whether the gateway is ready and the channel and slash commands are known."""
+        return super().is_ready() and self.__channel_resolved.is_set() and self.__commands_loaded.is_set()
+
+    async def wait_until_ready(self):
+        """Wait for the gateway, the channel and the slash commands."""
+        await super().wait_until_ready()
+        await self.__channel_resolved.wait()
+        await self.__commands_loaded.wait()
+
+    async def close(self):
+        for task in (self.__reconcile_task, self.__metadata_task):
+            if task:
+                task.cancel()
+        await super().close()
+
+    def __schedule_reconcile(self):
+        if self.__reconcile_task and not self.__reconcile_task.done():
+            return
+        self.__reconcile_task = asyncio.create_task(self.__run_reconcile())
+
+    async def __run_reconcile(self):
+        try:
+            await self.__channel_resolved.wait()
+            handled = await self.reconcile()
+            if handled:
+                print(f'reconciled in flight messages: {handled}')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+
+    @property
+    def __reconcile_cursor_key(self) -> str:
+        return f'reconcile_cursor:{self.channel_id}'
+
+    async def reconcile(self) -> int:
+        """
+        Catch up on edits missed while the gateway was down or the process restarted, by running the
+        in-flight messages through the result handlers again.
+
+        The channel history after the oldest in-flight message is read page by page, one request per
+        ``reconcile_request_interval`` seconds, and the last message read is stored as a cursor so an
+        interrupted run resumes from there. In-flight messages before the cursor or beyond
+        ``reconcile_max_history`` are fetched one by one, the ones which are gone fail their task.
+        """
+        pending = {int(x) for x in self.in_flight_tasks}
+        if not pending:
+            return 0
+        cursor = await self.cache.get_value(key=self.__reconcile_cursor_key)
+        after = min(pending) - 1
+        if cursor and int(cursor) > after:
+            after = int(cursor)
+        last_id = max(pending)
+
+        handled = 0
+        read = 0
+        async for message in self.channel.history(
+                limit=self.reconcile_max_history,
+                after=discord.Object(id=after),
+                oldest_first=True
+        ):
+            read += 1
+            if message.id in pending:
+                pending.discard(message.id)
+                await self.handle_result(message=message)
+                handled += 1
+            if message.id >= last_id:
+                break
+            if read % 100 == 0:
+                await self.cache.set_value(
+                    key=self.__reconcile_cursor_key,
+                    value=str(message.id),
+                    ex=self.cache.running_ttl
+                )
+                await asyncio.sleep(self.reconcile_request_interval)
+
+        for message_id in sorted(pending):
+            task_id = self.in_flight_tasks.get(str(message_id))
+            if not task_id:
+                continue
+            await asyncio.sleep(self.reconcile_request_interval)
+            try:
+                message = await self.channel.fetch_message(message_id)
+            except discord.NotFound:
+                await self.__fail_task(task_id=task_id, message_id=str(message_id), error='message deleted')
+                continue
+            await self.handle_result(message=message)
+            handled += 1
+
+        await self.cache.delete_value(key=self.__reconcile_cursor_key)
+        return handled
+
+    @property
+    def __commands_cache_key(self) -> str:
+        return f'slash_commands:{self.guild_id}:{self.application_id}'
+
+    def __set_slash_commands(self, data: dict):
+        applications = {
+            int(x['id']): self._connection.create_integration_application(x) for x in data['applications']
+        }
+        self.commands = {
+            x['name']: discord.SlashCommand(
+                state=self._connection,
+                data=x,
+                application=applications.get(int(x['application_id']))
+            )
+            for x in data['application_commands'] if x['type'] == ApplicationCommandType.chat_input.value
+        }
+        self.__commands_loaded.set()
+
+    async def __load_slash_commands(self):
+        value = await self.cache.get_value(key=self.__commands_cache_key)
+        if not value:
+            return
+        try:
+            self.__set_slash_commands(json.loads(value))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f'cached slash commands unreadable: {e!r}')
+            return
+        print(f'slash commands from cache: {list(self.commands)}')
+
+    async def refresh_slash_commands(self):
+        """Fetch the slash commands of the application from discord and save them to the cache."""
+        index = await self.http.guild_application_command_index(self.guild_id)
+        data = dict(
+            application_commands=[
+                x for x in index['application_commands'] if str(x['application_id']) == str(self.application_id)
+            ],
+            applications=[
+                x for x in index.get('applications') or [] if str(x['id']) == str(self.application_id)
+            ]
+        )
+        self.__set_slash_commands(data)
+        await self.cache.set_value(key=self.__commands_cache_key, value=json.dumps(data), ex=self.command_cache_ttl)
+        print(f'slash commands: {list(self.commands)}')
 
+    async def __resolve_channel(self):
+        self.guild = self.get_guild(self.guild_id) or await self.fetch_guild(self.guild_id)
+        self.channel = self.get_channel(self.channel_id) or await self.fetch_channel(self.channel_id)
         print(f'guild: {self.guild}')
         print(f'channel: {self.channel}')
-        print(f'slash commands: {self.commands.keys()}')
+        if self.lean and isinstance(self.guild, discord.Guild):
+            await self.guild.subscribe(typing=True, activities=False, threads=False, member_updates=False)
+        self.__channel_resolved.set()
 
-    async def on_ready(self):
-        print(f'Logged on as {self.user}')
+    def __schedule_metadata_refresh(self):
+        if self.__metadata_task and not self.__metadata_task.done():
+            return
+        self.__metadata_task = asyncio.create_task(self.__run_metadata_refresh())
 
-    async def __init_slash_commands(self):
-        commands: List[discord.SlashCommand] = [
-            x for x in await self.guild.application_commands() if
-            isinstance(x, discord.SlashCommand) and str(x.application_id) == str(self.application_id)
-        ]
-        for command in commands:
-            self.commands[command.name] = command
+    @staticmethod
+    def __log_retry(retry_state: RetryCallState):
+        print(f'channel or slash commands refresh failed, attempt {retry_state.attempt_number}: '
+              f'{retry_state.outcome.exception()!r}')
+
+    async def __run_metadata_refresh(self):
+        try:
+            # the account can't submit anything without its channel, or without commands when none are cached
+            async for attempt in AsyncRetrying(
+                    wait=wait_exponential(multiplier=1, max=60),
+                    before_sleep=self.__log_retry,
+                    reraise=True
+            ):
+                with attempt:
+                    await self.__resolve_channel()
+            async for attempt in AsyncRetrying(
+                    wait=wait_exponential(multiplier=1, max=60),
+                    stop=stop_after_attempt(1) if self.commands else stop_never,
+                    before_sleep=self.__log_retry,
+                    reraise=True
+            ):
+                with attempt:
+                    await self.refresh_slash_commands()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+
+    def __drop_other_channel_events(self):
+        parsers = self._connection.parsers
+        channel_id = str(self.channel_id)
+
+        def wrap(parser):
+            def parse(data):
+                if data.get('channel_id') != channel_id:
+                    self.dropped_events += 1
+                    return
+                parser(data)
+
+            return parse
+
+        for event in CHANNEL_EVENTS:
+            if event in parsers:
+                parsers[event] = wrap(parsers[event])
+
+    def __log_message(self, event: str, message: discord.Message):
+        if random.random() >= self.log_sample_rate:
+            return
+        interaction = message.interaction
+        print(f"{event}, message_id: {message.id}, author_id: {message.author.id}, "
+              f"interaction_id: {interaction.id if interaction else None}, "
+              f"interaction.nonce: {interaction.nonce if interaction else None}")
 
     async def on_message(self, message: discord.Message):
-        # if message.application_id != self.application_id:
-        #     return
+        if message.channel.id != self.channel_id:
+            return
+        self.__log_message('message', message)
 
-        print(
-            f"message: {message}, interaction_id: {message.interaction.id if message.interaction else None}, interaction.nonce: {message.interaction.nonce if message.interaction else None}")
+        if message.author.id == self.application_id:
+            self.correlator.feed(message)
 
         if message.content == 'ping':
             await message.channel.send('pong')
 
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if after.author.id != self.application_id:
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # raw, so edits of messages which dropped out of (or never were in) the message cache are seen
+        if payload.channel_id != self.channel_id:
             return
-        print(
-            f"message edit, before {before}, after: {after}")
-        if after.embeds:
-            embed: discord.Embed = after.embeds[0]
-            if embed.title.startswith('/gen'):
-                await self.handle_gen_result(message=after)
-            elif embed.title.startswith('/real'):
-                await self.handle_real_result(message=after)
-            elif embed.title == '/animate':
-                await self.handle_animate_result(message=after)
-            elif embed.title == '/video':
-                await self.handle_video_result(message=after)
-            elif embed.title == '/move':
-                await self.handle_move_result(message=after)
-        elif 'After:' in after.content and 'Before:' in after.content:
-            await self.handle_video_result(message=after)
-        elif 'Result:' in after.content and 'Image:' in after.content and 'Video:' in after.content:
-            await self.handle_move_result(message=after)
-
-    async def wait_for_generating_message(self, embeds_desc_keyword: str) -> discord.Message:
-        def check(message: discord.Message):
-            if not message.embeds or not message.mentions:
-                return False
-            if message.mentions[0].id != self.bot_user_id:
-                return False
-            return embeds_desc_keyword in message.embeds[0].description
-
-        return await self.wait_for(
-            'message',
-            check=check,
-            timeout=20
-        )
-
-    async def handle_gen_result(
-            self,
-            message: discord.Message
-    ):
-        if not message.attachments:
+        message = payload.message
+        if message.author.id != self.application_id:
+            return
+        if str(message.id) not in self.in_flight_tasks:
+            self.skipped_edits += 1
             return
-        attachment = message.attachments[0]
+        self.handled_edits += 1
+        self.__log_message('message edit', message)
+        await self.handle_result(message=message)
 
-        task_id = await self.cache.get_task_id_by_message_id(message_id=str(message.id))
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.channel_id != self.channel_id:
+            return
+        task_id = self.in_flight_tasks.get(str(payload.message_id))
         if not task_id:
             return
-        upscale_custom_ids = {}
-        vary_custom_ids = {}
-        for row in message.components:
-            for component in row.children:
-                if component.disabled or not component.label or not component.custom_id:
-                    continue
-                if component.label.startswith("U"):
-                    upscale_custom_ids[component.label] = component.custom_id
-                elif component.label.startswith("Vary"):
-                    vary_custom_ids["V1"] = component.custom_id
-                elif component.label.startswith("V"):
-                    vary_custom_ids[component.label] = component.custom_id
+        print(f"message deleted, message_id: {payload.message_id}, task_id: {task_id}")
+        await self.__fail_task(task_id=task_id, message_id=str(payload.message_id), error='message deleted')
 
-        data = TaskCacheData(
-            command=TaskCommand.GEN,
-            channel_id=str(message.channel.id),
-            guild_id=str(message.guild.id) if message.guild else None,
-            message_id=str(message.id),
-            images=[TaskAsset.from_attachment(attachment)],
-            status=TaskStatus.SUCCESS,
-            upscale_custom_ids=upscale_custom_ids,
-            vary_custom_ids=vary_custom_ids
+    async def wait_for_generating_message(
+            self,
+            interaction: discord.Interaction,
+            embeds_desc_keyword: str
+    ) -> discord.Message:
+        return await self.correlator.wait(
+            interaction=interaction,
+            embeds_desc_keyword=embeds_desc_keyword,
+            timeout=20
         )
+
+    async def get_task_id_by_message_id(self, message_id: str) -> Optional[str]:
+        # tasks bound by this process are known without a cache round trip
+        task_id = self.in_flight_tasks.get(message_id)
+        if task_id:
+            return task_id
+        return await self.cache.get_task_id_by_message_id(message_id=message_id)
+
+    async def __save_task_result(self, task_id: str, data: TaskCacheData):
         await self.cache.set_task_id2data(task_id=task_id, data=data)
+        self.forget_task(message_id=data.message_id)
         await self.event_callback.send_task_success(task_id=task_id, data=data)
 
-    async def handle_real_result(
-            self,
-            message: discord.Message
-    ):
-        if not message.attachments:
+    async def __fail_task(self, task_id: str, message_id: str, error: str):
+        self.forget_task(message_id=message_id)
+        await fail_task(cache=self.cache, event_callback=self.event_callback, task_id=task_id, error=error)
+
+    def bind_task(self, message_id: str, task_id: str, data: TaskCacheData):
+        self.in_flight_tasks[message_id] = task_id
+        self.in_flight_records[message_id] = data
+
+    def forget_task(self, message_id: str):
+        task_id = self.in_flight_tasks.pop(message_id, None)
+        self.in_flight_records.pop(message_id, None)
+        if task_id and self.on_slot_freed:
+            self.on_slot_freed()
+        self.task_progress.pop(message_id, None)
+
+    async def handle_result(self, message: discord.Message):
+        result = parse_result(message)
+        if result is None:
+            error = parse_error(message)
+            if error is None:
+                await self.handle_progress(message=message)
+                return
+            task_id = await self.get_task_id_by_message_id(message_id=str(message.id))
+            if task_id:
+                await self.__fail_task(task_id=task_id, message_id=str(message.id), error=error)
             return
-        attachment = message.attachments[0]
-
-        task_id = await self.cache.get_task_id_by_message_id(message_id=str(message.id))
+        task_id = await self.get_task_id_by_message_id(message_id=str(message.id))
         if not task_id:
             return
-        upscale_custom_ids = {}
-        vary_custom_ids = {}
-        for row in message.components:
-            for component in row.children:
-                if component.disabled or not component.label or not component.custom_id:
-                    continue
-                if component.label.startswith("U"):
-                    upscale_custom_ids[component.label] = component.custom_id
-                elif component.label.startswith("Vary"):
-                    vary_custom_ids["V1"] = component.custom_id
-                elif component.label.startswith("V"):
-                    vary_custom_ids[component.label] = component.custom_id
-
+        last_progress = self.task_progress.get(str(message.id))
+        # the timestamps of the task, from the last progress or the record bound by this process, read from the
+        # cache only for tasks bound elsewhere
+        base = last_progress.data if last_progress else self.in_flight_records.get(str(message.id))
+        if base is None:
+            base = await self.cache.get_task_data_by_id(task_id=task_id)
         data = TaskCacheData(
-            command=TaskCommand.REAL,
+            command=result.command,
             channel_id=str(message.channel.id),
             guild_id=str(message.guild.id) if message.guild else None,
             message_id=str(message.id),
-            images=[TaskAsset.from_attachment(attachment)],
+            account_id=self.account_id,
+            images=result.images,
+            videos=result.videos,
             status=TaskStatus.SUCCESS,
-            upscale_custom_ids=upscale_custom_ids,
-            vary_custom_ids=vary_custom_ids
+            upscale_custom_ids=result.upscale_custom_ids,
+            vary_custom_ids=result.vary_custom_ids,
+            created_at=base.created_at if base else None,
+            submitted_at=base.submitted_at if base else None,
+            started_at=base.started_at if base else None,
+            mode=base.mode if base else None
         )
-
-        await self.cache.set_task_id2data(task_id=task_id, data=data)
-        await self.event_callback.send_task_success(task_id=task_id, data=data)
-
-    async def handle_video_result(
-            self,
-            message: discord.Message
-    ):
-        task_id = await self.cache.get_task_id_by_message_id(message_id=str(message.id))
+        now = time.time()
+        if data.started_at:
+            observe_stage('generation', now - data.started_at, command=data.command, mode=data.mode)
+        if data.created_at:
+            observe_stage('total', now - data.created_at, command=data.command, mode=data.mode)
+        await self.__save_task_result(task_id=task_id, data=data)
+
+    async def handle_progress(self, message: discord.Message):
+        progress = parse_progress(message)
+        if progress is None:
+            return
+        message_id = str(message.id)
+        task_id = self.in_flight_tasks.get(message_id)
         if not task_id:
             return
-
-        if message.attachments:
-            attachment = message.attachments[0]
-            asset = TaskAsset.from_attachment(attachment)
+        last = self.task_progress.get(message_id)
+        if last is None:
+            # the first progress of a task builds on the record written on submission
+            base = await self.cache.get_task_data_by_id(task_id=task_id)
+            if base is None or base.status.is_finished:
+                return
         else:
-            match = re.search(r"After:.*?(https:.*)", message.content)
-            if not match:
+            base = last.data
+        started_at = base.started_at
+        if progress.started and started_at is None:
+            started_at = time.time()
+            if base.submitted_at:
+                observe_stage('domoai_queue', started_at - base.submitted_at, command=base.command, mode=base.mode)
+        data = base.model_copy(update=dict(
+            message_id=message_id,
+            status=TaskStatus.RUNNING,
+            progress_percent=progress.progress_percent,
+            queue_position=progress.queue_position,
+            started_at=started_at
+        ))
+        now = time.monotonic()
+        if last is not None:
+            if last.data == data:
                 return
-            video_url = match.group(1)
-            asset = TaskAsset(
-                url=video_url,
-                proxy_url=video_url
-            )
-
-        data = TaskCacheData(
-            command=TaskCommand.VIDEO,
-            channel_id=str(message.channel.id),
-            guild_id=str(message.guild.id) if message.guild else None,
-            message_id=str(message.id),
-            videos=[asset],
-            status=TaskStatus.SUCCESS
-        )
-
+            # the start of the generation is always written, percentage updates at most every progress_min_interval
+            if last.data.started_at == started_at and now - last.written_at < self.progress_min_interval:
+                return
+        self.task_progress[message_id] = TaskProgressWrite(written_at=now, data=data)
         await self.cache.set_task_id2data(task_id=task_id, data=data)
-        await self.event_callback.send_task_success(task_id=task_id, data=data)
 
-    async def handle_animate_result(
+    async def __upload(self, file: discord.File, digests: List[str], use_cache: bool) -> Tuple[discord.CloudFile, bool]:
+        """Upload ``file``, or reuse its earlier upload, returns the upload and whether it was reused."""
+        digest = await self.upload_cache.digest(file)
+        digests.append(digest)
+        uploaded = await self.upload_cache.get(digest) if use_cache else None
+        if uploaded is not None:
+            return uploaded, True
+        file.reset()
+        started_at = time.monotonic()
+        uploaded = (await self.channel.upload_files(file))[0]
+        observe_submit_stage('discord_upload', time.monotonic() - started_at)
+        await self.upload_cache.set(digest, uploaded)
+        return uploaded, False
+
+    async def __try_invoke(
             self,
-            message: discord.Message
-    ):
-        task_id = await self.cache.get_task_id_by_message_id(message_id=str(message.id))
-        if not task_id:
-            return
-
-        if not message.attachments:
-            return
-
-        attachment = message.attachments[0]
-        asset = TaskAsset.from_attachment(attachment)
-
-        data = TaskCacheData(
-            command=TaskCommand.ANIMATE,
-            channel_id=str(message.channel.id),
-            guild_id=str(message.guild.id) if message.guild else None,
-            message_id=str(message.id),
-            videos=[asset],
-            status=TaskStatus.SUCCESS
-        )
-        await self.cache.set_task_id2data(task_id=task_id, data=data)
-        await self.event_callback.send_task_success(task_id=task_id, data=data)
-
-    async def handle_move_result(
+            command: discord.SlashCommand,
+            options: dict,
+            files: Dict[str, discord.File],
+            reused: List[bool],
+            use_upload_cache: bool
+    ) -> discord.Interaction:
+        digests = []
+        options = dict(options)
+        for name, file in files.items():
+            options[name], was_reused = await self.__upload(file, digests, use_cache=use_upload_cache)
+            reused.append(was_reused)
+        interaction = None
+        started_at = time.monotonic()
+        try:
+            interaction = await command(self.channel, **options)
+            observe_submit_stage('dispatch', time.monotonic() - started_at)
+            return interaction
+        finally:
+            if interaction is None or not interaction.successful:
+                # the uploads may be gone on discord's side, upload them again next time
+                for digest in digests:
+                    await self.upload_cache.delete(digest)
+
+    async def __invoke(
             self,
-            message: discord.Message
-    ):
-        task_id = await self.cache.get_task_id_by_message_id(message_id=str(message.id))
-        if not task_id:
-            return
-
-        if message.attachments:
-            attachment = message.attachments[0]
-            asset = TaskAsset.from_attachment(attachment)
-        else:
-            match = re.search(r"Result:.*?(https:.*)", message.content)
-            if not match:
-                return
-            video_url = match.group(1)
-            asset = TaskAsset(
-                url=video_url,
-                proxy_url=video_url
-            )
-
-        data = TaskCacheData(
-            command=TaskCommand.MOVE,
-            channel_id=str(message.channel.id),
-            guild_id=str(message.guild.id) if message.guild else None,
-            message_id=str(message.id),
-            videos=[asset],
-            status=TaskStatus.SUCCESS
-        )
-        await self.cache.set_task_id2data(task_id=task_id, data=data)
-        await self.event_callback.send_task_success(task_id=task_id, data=data)
+            command: discord.SlashCommand,
+            options: dict,
+            files: Optional[Dict[str, discord.File]] = None
+    ) -> discord.Interaction:
+        """Upload ``files`` as the options of their name and send the command."""
+        files = files or {}
+        try:
+            reused: List[bool] = []
+            try:
+                interaction = await self.__try_invoke(command, options, files, reused, use_upload_cache=True)
+                if interaction.successful or not any(reused):
+                    return interaction
+                error = f'interaction {interaction.id} was not successful'
+            except discord.HTTPException as e:
+                # discord rejected the interaction (or an upload), nothing was submitted. Anything else, e.g.
+                # InvalidData when no response came in time, may have been submitted and is never retried
+                if not any(reused):
+                    raise
+                error = repr(e)
+            # a reused upload may have expired on discord's side, costing the task, upload once more
+            print(f"/{command.name} with reused uploads failed, retrying with fresh uploads: {error}")
+            return await self.__try_invoke(command, options, files, [], use_upload_cache=False)
+        finally:
+            for file in files.values():
+                file.close()
 
     async def gen(
             self,
@@ -289,13 +604,11 @@ class DiscordUserClient(discord.Client):
         options = dict(
             prompt=request_prompt
         )
+        files = {}
         if image:
-            uploaded_image_files = await self.channel.upload_files(image)
-            image.close()
-            options['img2img'] = uploaded_image_files[0]
+            files['img2img'] = image
 
-        interaction = await command(self.channel, **options)
-        return interaction
+        return await self.__invoke(command, options, files)
 
     async def real(
             self,
@@ -306,11 +619,7 @@ class DiscordUserClient(discord.Client):
         command = self.commands.get('real')
         if not command:
             return None
-        uploaded_image_files = await self.channel.upload_files(image)
-        image.close()
-        options = dict(
-            image=uploaded_image_files[0]
-        )
+        options = {}
         request_prompt_parts = []
         if prompt:
             request_prompt_parts.append(prompt)
@@ -321,8 +630,7 @@ class DiscordUserClient(discord.Client):
         if request_prompt_parts:
             options['prompt'] = ' '.join(request_prompt_parts)
 
-        interaction = await command(self.channel, **options)
-        return interaction
+        return await self.__invoke(command, options, dict(image=image))
 
     async def click_button(
             self,
@@ -335,6 +643,7 @@ class DiscordUserClient(discord.Client):
         }
 
         nonce = _generate_nonce()
+        started_at = time.monotonic()
 
         try:
             payload = {
@@ -367,6 +676,7 @@ class DiscordUserClient(discord.Client):
                 check=lambda d: d.nonce == nonce,
                 timeout=12,
             )
+            observe_submit_stage('dispatch', time.monotonic() - started_at)
             return i
         except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
             raise InvalidData('Did not receive a response from Discord') from exc
@@ -384,22 +694,15 @@ class DiscordUserClient(discord.Client):
         command = self.commands.get('move')
         if not command:
             return None
-        uploaded_images = await self.channel.upload_files(image)
-        image.close()
-
-        uploaded_videos = await self.channel.upload_files(video)
-        video.close()
         request_prompt = f"{prompt} --{model.value} --length {length.value}"
         if mode:
             request_prompt += f' --{mode.value}'
         if video_key:
             request_prompt += f'  --key {video_key.value.lower()}'
         options = dict(
-            prompt=request_prompt,
-            video=uploaded_videos[0],
-            image=uploaded_images[0]
+            prompt=request_prompt
         )
-        return await command(self.channel, **options)
+        return await self.__invoke(command, options, dict(image=image, video=video))
 
     async def video(
             self,
@@ -417,11 +720,6 @@ class DiscordUserClient(discord.Client):
         command = self.commands.get('video')
         if not command:
             return None
-        uploaded_videos = await self.channel.upload_files(video)
-        uploaded_image = None
-        if image:
-            uploaded_image = await self.channel.upload_files(image)
-        video.close()
         if refer_mode == VideoReferMode.REFER_TO_MY_PROMPT_MORE:
             refer_mode_value = 'p'
         else:
@@ -436,12 +734,12 @@ class DiscordUserClient(discord.Client):
         if lip_sync:
             request_prompt += f'  --lips'
         options = dict(
-            prompt=request_prompt,
-            video=uploaded_videos[0]
+            prompt=request_prompt
         )
-        if uploaded_image:
-            options['image'] = uploaded_image[0]
-        return await command(self.channel, **options)
+        files = dict(video=video)
+        if image:
+            files['image'] = image
+        return await self.__invoke(command, options, files)
 
     async def animate(
             self,
@@ -454,15 +752,12 @@ class DiscordUserClient(discord.Client):
         command = self.commands.get('animate')
         if not command:
             return None
-        uploaded_images = await self.channel.upload_files(image)
-        image.close()
         request_prompt = f"--intensity {intensity.value} --length {length.value}"
         if prompt:
             request_prompt = f"{prompt} " + request_prompt
         if mode:
             request_prompt += f' --{mode.value}'
         options = dict(
-            prompt=request_prompt,
-            image=uploaded_images[0]
+            prompt=request_prompt
         )
-        return await command(self.channel, **options)
+        return await self.__invoke(command, options, dict(image=image))
@@ -0,0 +1,72 @@
+"""
+Compare bytes per record and encode / decode cost of the task data codecs.
+
+Usage (from the repository root): python -m scripts.benchmark_codec
+"""
+import timeit
+from typing import Dict
+
+from app.cache import JsonTaskDataCodec, MsgpackTaskDataCodec, TaskDataCodec
+from app.schema import TaskCacheData, TaskCommand, TaskStatus, TaskAsset
+
+
+def attachment_asset(name: str, content_type: str, size: int, width: int, height: int) -> TaskAsset:
+    path = f'attachments/1204399999999999999/1204400000000000000/{name}?ex=65d0c0a1&is=65be4ba1&hm=' \
+           f'4b8a2f0e0f8c6d5e3a1b9c7d6e5f4a3b2c1d0e9f8a7b6c5d4e3f2a1b0c9d8e7f&'
+    return TaskAsset(
+        size=size,
+        width=width,
+        height=height,
+        url=f'https://cdn.discordapp.com/{path}',
+        proxy_url=f'https://media.discordapp.net/{path}',
+        content_type=content_type
+    )
+
+
+def sample_records() -> Dict[str, TaskCacheData]:
+    base = dict(
+        channel_id='1204399999999999999',
+        guild_id='1204388888888888888',
+        message_id='1204400000000000000',
+        account_id='1104377777777777777',
+    )
+    return {
+        'running': TaskCacheData(command=TaskCommand.VIDEO, status=TaskStatus.RUNNING, **base),
+        'gen success': TaskCacheData(
+            command=TaskCommand.GEN,
+            status=TaskStatus.SUCCESS,
+            images=[attachment_asset('grid_0.png', 'image/png', 6325441, 2048, 2048)],
+            upscale_custom_ids={f'U{i}': f'MJ::JOB::upsample::{i}::7c4b1d2e-5b8c-4f6b-9d0e-2a1b3c4d5e6f' for i in
+                                range(1, 5)},
+            vary_custom_ids={f'V{i}': f'MJ::JOB::variation::{i}::7c4b1d2e-5b8c-4f6b-9d0e-2a1b3c4d5e6f' for i in
+                             range(1, 5)},
+            **base
+        ),
+        'video success': TaskCacheData(
+            command=TaskCommand.VIDEO,
+            status=TaskStatus.SUCCESS,
+            videos=[attachment_asset('video.mp4', 'video/mp4', 12582912, 1280, 720)],
+            **base
+        ),
+    }
+
+
+def benchmark(codec: TaskDataCodec, data: TaskCacheData, number: int):
+    value = codec.encode(data)
+    assert codec.decode(value) == data
+    size = len(value.encode() if isinstance(value, str) else value)
+    encode_us = timeit.timeit(lambda: codec.encode(data), number=number) / number * 1e6
+    decode_us = timeit.timeit(lambda: codec.decode(value), number=number) / number * 1e6
+    return size, encode_us, decode_us
+
+
+if __name__ == '__main__':
+    codecs = {
+        'json': JsonTaskDataCodec(),
+        'msgpack': MsgpackTaskDataCodec(),
+    }
+    print(f"{'record':<16}{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for record_name, record in sample_records().items():
+        for codec_name, codec in codecs.items():
+            size, encode_us, decode_us = benchmark(codec, record, number=20000)
+            print(f"{record_name:<16}{codec_name:<10}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}")
@@ -0,0 +1,55 @@
+"""
+Measure messages parsed per second by app.result_parser on result message fixtures.
+
+The fixtures are synthetic, written after the shape of DomoAI's replies: ids, urls and custom ids are made up.
+
+Usage (from the repository root): python -m scripts.benchmark_result_parser
+"""
+import json
+import os
+import time
+from types import SimpleNamespace
+from typing import List
+
+from app.result_parser import parse_result
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_fixtures() -> List[SimpleNamespace]:
+    """Load the fixture messages as objects exposing the discord.Message attributes the parser reads."""
+    with open(os.path.join(current_dir, 'fixtures/result_messages.json'), 'r') as f:
+        raw_messages = json.load(f)
+    return [
+        SimpleNamespace(
+            name=x['name'],
+            id=int(x['id']),
+            content=x['content'],
+            embeds=[SimpleNamespace(**embed) for embed in x['embeds']],
+            attachments=[SimpleNamespace(**attachment) for attachment in x['attachments']],
+            components=[
+                SimpleNamespace(children=[SimpleNamespace(**child) for child in row['children']])
+                for row in x['components']
+            ]
+        )
+        for x in raw_messages
+    ]
+
+
+def benchmark(messages: List[SimpleNamespace], seconds: float = 2.0) -> float:
+    parsed = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for message in messages:
+            parse_result(message)
+        parsed += len(messages)
+    return parsed / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    fixtures = load_fixtures()
+    for fixture in fixtures:
+        result = parse_result(fixture)
+        print(f"{fixture.name:<24}{result.command.value if result else '-':<10}"
+              f"{benchmark([fixture], seconds=0.5):>14,.0f} msg/s")
+    print(f"{'all fixtures':<34}{benchmark(fixtures):>14,.0f} msg/s")
@@ -0,0 +1,46 @@
+"""
+Report key counts and bytes per key family under the cache prefix.
+
+Usage (from the repository root): python -m scripts.cache_stats
+"""
+import asyncio
+import os
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from app.cache import RedisCache
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class ScriptSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=os.path.join(current_dir, '../.env'),
+        env_file_encoding='utf-8',
+        extra='ignore'
+    )
+    redis_uri: Optional[str] = None
+    cache_prefix: str = 'domoai:'
+
+
+async def cache_stats(redis_uri: str, prefix: str):
+    redis = await RedisCache.init_redis_pool(redis_uri=redis_uri)
+    cache = RedisCache(redis=redis, prefix=prefix)
+    try:
+        stats = await cache.key_family_stats()
+    finally:
+        await cache.close()
+
+    print(f"{'family':<32}{'keys':>12}{'bytes':>16}{'avg bytes':>12}")
+    for family, family_stats in sorted(stats.items()):
+        avg = family_stats.bytes // family_stats.keys if family_stats.keys else 0
+        print(f"{family:<32}{family_stats.keys:>12}{family_stats.bytes:>16}{avg:>12}")
+    print(f"{'total':<32}{sum(x.keys for x in stats.values()):>12}{sum(x.bytes for x in stats.values()):>16}")
+
+
+if __name__ == '__main__':
+    settings = ScriptSettings()
+    if not settings.redis_uri:
+        raise SystemExit('REDIS_URI is not set')
+    asyncio.run(cache_stats(redis_uri=settings.redis_uri, prefix=settings.cache_prefix))
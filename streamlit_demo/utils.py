@@ -26,12 +26,14 @@ else:
 async def polling_check_state(task_id: str) -> Optional[dict]:
     async with httpx.AsyncClient(base_url=BASE_URL, headers=BASE_HEADERS) as client:
         while True:
-            response = await client.get(f'/v1/task-data/{task_id}')
+            response = await client.get(f'/v1/task-data/{task_id}', params={'wait': 30}, timeout=40)
             if response.status_code == 404:
                 return None
             response_json = response.json()
             if response_json['status'] == 'SUCCESS':
                 return response_json
+            if response_json['status'] in ('FAILED', 'TIMEOUT'):
+                return None
             await asyncio.sleep(1)
 
 
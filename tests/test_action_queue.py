@@ -0,0 +1,183 @@
+import asyncio
+import io
+import os
+
+import msgpack
+import pytest
+from fakeredis.aioredis import FakeRedis
+
+import app.action_queue
+from app.account_pool import DiscordUserClientPool
+from app.action_queue import ActionQueueFullError, ActionQueueWorker, ActionType, GenActionParams, \
+    MemoryActionQueue, QueuedFile, RedisActionQueue, new_action
+from app.cache import MemoryCache
+from app.schema import TaskCacheData, TaskCommand, TaskStatus
+from app.user_client import DiscordUserClient
+
+
+def gen_action(task_id: str):
+    return new_action(task_id, ActionType.GEN, TaskCommand.GEN, GenActionParams(prompt=task_id))
+
+
+def test_memory_queue():
+    async def run():
+        queue = MemoryActionQueue(max_size=2)
+        await queue.put(gen_action('t1'))
+        await queue.put(gen_action('t2'))
+        with pytest.raises(ActionQueueFullError):
+            await queue.put(gen_action('t3'))
+        assert await queue.qsize() == 2
+        assert [(await queue.get()).task_id for _ in range(2)] == ['t1', 't2']
+        assert await queue.qsize() == 0
+
+    asyncio.run(run())
+
+
+def test_redis_queue_carries_files(tmp_path):
+    async def run():
+        os.mkdir(tmp_path / 'gateway')
+        queue = RedisActionQueue(FakeRedis(), prefix='test:', spool_dir=str(tmp_path / 'gateway'))
+        action = gen_action('t1')
+        action.files['image'] = QueuedFile.spool(io.BytesIO(b'image bytes'), 'a.png', str(tmp_path))
+        spooled = action.files['image'].path
+        await queue.put(action)
+        # the upload travels in the record, the api worker's copy is gone
+        assert not os.path.exists(spooled)
+        got = await queue.get()
+        assert got.model_dump(exclude={'files'}) == action.model_dump(exclude={'files'})
+        assert got.files['image'].filename == 'a.png'
+        assert got.files['image'].read_bytes() == b'image bytes'
+        assert os.path.dirname(got.files['image'].path) == str(tmp_path / 'gateway')
+
+    asyncio.run(run())
+
+
+def test_redis_queue_order_and_bound():
+    async def run():
+        queue = RedisActionQueue(FakeRedis(), prefix='test:', max_size=2)
+        await queue.put(gen_action('t1'))
+        await queue.put(gen_action('t2'))
+        with pytest.raises(ActionQueueFullError):
+            await queue.put(gen_action('t3'))
+        assert await queue.qsize() == 2
+        assert [(await queue.get()).task_id for _ in range(2)] == ['t1', 't2']
+        assert await queue.qsize() == 0
+
+    asyncio.run(run())
+
+
+def test_redis_queue_recovers_unacknowledged_actions():
+    async def run():
+        redis = FakeRedis()
+        stopped = RedisActionQueue(redis, prefix='test:')
+        for task_id in ('t1', 't2', 't3', 't4'):
+            await stopped.put(gen_action(task_id))
+        first = await stopped.get()
+        await stopped.get()
+        await stopped.ack(first)
+        await stopped.get()
+        # t2 and t3 were taken and never acknowledged when the gateway stopped
+        gateway = RedisActionQueue(redis, prefix='test:')
+        assert await gateway.recover() == 2
+        assert await gateway.qsize() == 3
+        assert [(await gateway.get()).task_id for _ in range(3)] == ['t2', 't3', 't4']
+        assert await redis.smembers(gateway.processing_keys_key) == {gateway.processing_key.encode()}
+        assert await redis.llen(stopped.processing_key) == 0
+
+    asyncio.run(run())
+
+
+def test_redis_queue_sets_unreadable_records_aside():
+    async def run():
+        redis = FakeRedis()
+        queue = RedisActionQueue(redis, prefix='test:')
+        await redis.lpush(queue.key, b'not msgpack')
+        await redis.lpush(queue.key, msgpack.packb({'action': {'task_id': 'x'}, 'files': {}}))
+        await queue.put(gen_action('t1'))
+        assert (await queue.get()).task_id == 't1'
+        assert len(await redis.lrange(queue.dead_letter_key, 0, -1)) == 2
+        assert len(await redis.lrange(queue.processing_key, 0, -1)) == 1
+
+    asyncio.run(run())
+
+
+class FlakyQueue(MemoryActionQueue):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def get(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('queue unreachable')
+        return await super().get()
+
+
+def test_worker_survives_queue_errors(monkeypatch):
+    async def run():
+        monkeypatch.setattr(app.action_queue, 'GET_RETRY_MIN_INTERVAL', 0.01)
+        queue = FlakyQueue(failures=5)
+        worker = ActionQueueWorker(
+            queue=queue,
+            pool=DiscordUserClientPool(),
+            cache=None,
+            event_callback=None,
+            max_concurrent_per_account=3
+        )
+        processed = []
+
+        async def process(action):
+            processed.append(action.task_id)
+
+        worker.process = process
+        worker.start()
+        await queue.put(gen_action('t1'))
+        await queue.put(gen_action('t2'))
+        for _ in range(100):
+            if len(processed) == 2:
+                break
+            await asyncio.sleep(0.01)
+        await worker.close()
+        assert sorted(processed) == ['t1', 't2']
+
+    asyncio.run(run())
+
+
+def test_actions_wait_in_the_queue_while_accounts_are_busy():
+    async def run():
+        client = DiscordUserClient(channel_id=2, guild_id=1, application_id=3, cache=MemoryCache(), event_callback=None)
+        pool = DiscordUserClientPool()
+        pool.add(client)
+        queue = MemoryActionQueue()
+        worker = ActionQueueWorker(
+            queue=queue,
+            pool=pool,
+            cache=None,
+            event_callback=None,
+            max_concurrent_per_account=2
+        )
+
+        async def process(action):
+            # binds the task to a message like the real process, holding the slot until the task finishes
+            async with pool.dispatch(max_in_flight=2) as dispatched:
+                dispatched.bind_task(
+                    message_id=action.task_id,
+                    task_id=action.task_id,
+                    data=TaskCacheData(command=TaskCommand.GEN, status=TaskStatus.RUNNING)
+                )
+
+        worker.process = process
+        worker.start()
+        for task_id in ('t1', 't2', 't3'):
+            await queue.put(gen_action(task_id))
+        await asyncio.sleep(0.05)
+        assert list(client.in_flight_tasks) == ['t1', 't2']
+        assert await queue.qsize() == 1
+        client.forget_task(message_id='t1')
+        await asyncio.sleep(0.05)
+        assert list(client.in_flight_tasks) == ['t2', 't3']
+        assert await queue.qsize() == 0
+        await worker.close()
+        await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,169 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+import app.cache
+from app.cache import MemoryCache, NearCachedRedisCache
+from app.schema import TaskCacheData, TaskCommand, TaskStatus
+from app.task_events import TaskEventHub
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(app.cache, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_memory_cache_expires_values(clock):
+    async def run():
+        cache = MemoryCache(prefix='p:')
+        await cache.set_value('a', 'value', ex=10)
+        await cache.set_value('forever', 'value')
+        clock.now += 9
+        assert await cache.get_value('a') == 'value'
+        clock.now += 1
+        assert await cache.get_value('a') is None
+        assert await cache.get_value('forever') == 'value'
+        assert 'p:a' not in cache.data
+        assert cache.stats() == dict(
+            entries=1,
+            bytes=len('p:forever') + len('value'),
+            hits=2,
+            misses=1,
+            evictions=0,
+            expirations=1
+        )
+
+    asyncio.run(run())
+
+
+def test_memory_cache_extends_expiry(clock):
+    async def run():
+        cache = MemoryCache()
+        await cache.set_value('a', 'value', ex=10)
+        await cache.set_value('b', 'value', ex=10)
+        clock.now += 5
+        assert await cache.get_value_ex('a', ex=10) == 'value'
+        await cache.expire_value('b', ex=20)
+        clock.now += 9
+        assert await cache.get_value('a') == 'value'
+        assert await cache.get_value('b') == 'value'
+        clock.now += 11
+        assert await cache.get_value('a') is None
+        assert await cache.get_value('b') is None
+
+    asyncio.run(run())
+
+
+def test_memory_cache_evicts_least_recently_used_entries():
+    async def run():
+        cache = MemoryCache(max_entries=2)
+        await cache.set_value('a', 1)
+        await cache.set_value('b', 2)
+        assert await cache.get_value('a') == 1
+        await cache.set_value('c', 3)
+        assert list(cache.data) == ['a', 'c']
+        # overwriting moves a key to the end too
+        await cache.set_value('a', 4)
+        await cache.set_value('d', 5)
+        assert list(cache.data) == ['a', 'd']
+        assert cache.evictions == 2
+
+    asyncio.run(run())
+
+
+def test_memory_cache_evicts_by_bytes():
+    async def run():
+        cache = MemoryCache(max_bytes=30)
+        await cache.set_value('a', 'x' * 9)
+        await cache.set_value('b', 'x' * 9)
+        await cache.set_value('c', 'x' * 9)
+        assert list(cache.data) == ['a', 'b', 'c'] and cache.bytes == 30
+        await cache.set_value('a', 'x' * 19)
+        assert list(cache.data) == ['c', 'a'] and cache.bytes == 30
+        # a value larger than the cache doesn't stay either
+        await cache.set_value('big', 'x' * 64)
+        assert not cache.data and cache.bytes == 0
+        assert cache.evictions == 4
+
+    asyncio.run(run())
+
+
+def test_memory_cache_sweep(clock):
+    async def run():
+        cache = MemoryCache(max_entries=10)
+        for key, ex in (('a', 5), ('b', 10), ('c', None)):
+            await cache.set_value(key, key, ex=ex)
+        await cache.add_set_members('index', 'a', 'b')
+        clock.now += 5
+        assert cache.sweep() == 1
+        assert list(cache.data) == ['b', 'c']
+        clock.now += 100
+        assert cache.sweep() == 1
+        assert list(cache.data) == ['c']
+        assert cache.expirations == 2 and cache.hits == cache.misses == 0
+        # sets are indexes, neither swept nor evicted
+        assert sorted(await cache.get_set_members('index')) == ['a', 'b']
+
+    asyncio.run(run())
+
+
+def test_memory_cache_task_retention(clock):
+    async def run():
+        cache = MemoryCache(running_ttl=100, finished_ttl=10)
+        data = TaskCacheData(command=TaskCommand.GEN, status=TaskStatus.RUNNING)
+        await cache.set_task_id2data(task_id='t1', data=data)
+        assert await cache.get_running_task_ids() == ['t1']
+        clock.now += 50
+        assert await cache.get_task_data_by_id(task_id='t1') == data
+        data.status = TaskStatus.SUCCESS
+        await cache.set_task_id2data(task_id='t1', data=data)
+        assert await cache.get_running_task_ids() == []
+        clock.now += 11
+        assert await cache.get_task_data_by_id(task_id='t1') is None
+
+    asyncio.run(run())
+
+
+class CountingRedis(FakeRedis):
+    gets = 0
+
+    async def get(self, name):
+        CountingRedis.gets += 1
+        return await super().get(name)
+
+
+def test_remote_writes_are_reloaded_for_subscribers_only():
+    async def run():
+        server = FakeServer()
+        gateway = NearCachedRedisCache(redis=FakeRedis(server=server))
+        hub = TaskEventHub()
+        api = NearCachedRedisCache(redis=CountingRedis(server=server), remote_write_filter=hub.has_subscribers)
+        api.add_task_listener(hub.publish)
+        api.start_invalidation_listener()
+        await asyncio.sleep(0.05)
+        with hub.subscribe(task_id='waited') as events:
+            for task_id in ('unwatched', 'waited'):
+                await gateway.set_task_id2data(
+                    task_id=task_id,
+                    data=TaskCacheData(command=TaskCommand.GEN, status=TaskStatus.SUCCESS)
+                )
+            task_id, data = await asyncio.wait_for(events.get(), timeout=1)
+        assert task_id == 'waited' and data.status == TaskStatus.SUCCESS
+        assert CountingRedis.gets == 1
+        await api.close()
+        await gateway.close()
+
+    asyncio.run(run())
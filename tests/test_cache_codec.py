@@ -0,0 +1,55 @@
+import pytest
+
+from app.cache import JsonTaskDataCodec, MsgpackTaskDataCodec
+from app.schema import Mode, TaskAsset, TaskCacheData, TaskCommand, TaskStatus
+from scripts.benchmark_codec import sample_records
+
+RECORDS = {
+    **sample_records(),
+    'timed': TaskCacheData(
+        command=TaskCommand.MOVE,
+        status=TaskStatus.TIMEOUT,
+        error='no result after 3600s (RUNNING)',
+        progress_percent=80,
+        queue_position=0,
+        created_at=1700000000.25,
+        submitted_at=1700000001.5,
+        started_at=1700000010.0,
+        mode=Mode.RELAX
+    ),
+    'non numeric ids': TaskCacheData(command=TaskCommand.GEN, status=TaskStatus.QUEUED, channel_id='abc'),
+}
+
+
+@pytest.mark.parametrize('name', RECORDS)
+@pytest.mark.parametrize('codec', [MsgpackTaskDataCodec(), JsonTaskDataCodec()], ids=['msgpack', 'json'])
+def test_round_trip(codec, name):
+    data = RECORDS[name]
+    assert codec.decode(codec.encode(data)) == data
+
+
+@pytest.mark.parametrize('name', RECORDS)
+def test_codecs_read_each_other(name):
+    data = RECORDS[name]
+    assert MsgpackTaskDataCodec().decode(JsonTaskDataCodec().encode(data)) == data
+    assert JsonTaskDataCodec().decode(MsgpackTaskDataCodec().encode(data)) == data
+
+
+def test_msgpack_is_smaller():
+    for data in RECORDS.values():
+        assert len(MsgpackTaskDataCodec().encode(data)) < len(JsonTaskDataCodec().encode(data))
+
+
+def test_custom_proxy_url_is_kept():
+    asset = TaskAsset(url='https://example.com/a.png', proxy_url='https://proxy.example.com/a.png')
+    data = TaskCacheData(command=TaskCommand.REAL, status=TaskStatus.SUCCESS, images=[asset])
+    codec = MsgpackTaskDataCodec()
+    assert codec.decode(codec.encode(data)).images[0].proxy_url == 'https://proxy.example.com/a.png'
+
+
+def test_unknown_version_is_rejected():
+    codec = MsgpackTaskDataCodec()
+    value = codec.encode(RECORDS['timed'])
+    value = value[:1] + bytes([MsgpackTaskDataCodec.VERSION + 1]) + value[2:]
+    with pytest.raises(ValueError):
+        codec.decode(value)
@@ -0,0 +1,131 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+
+from app.correlation import InteractionCorrelator
+from app.result_parser import parse_error
+
+BOT_USER_ID = 1
+
+
+def interaction(interaction_id: int, nonce: Optional[str] = None) -> SimpleNamespace:
+    return SimpleNamespace(id=interaction_id, nonce=nonce)
+
+
+def reply(
+        description: str,
+        interaction_id: Optional[int] = None,
+        nonce: Optional[str] = None,
+        title: Optional[str] = None
+) -> SimpleNamespace:
+    return SimpleNamespace(
+        interaction=interaction(interaction_id, nonce) if interaction_id else None,
+        embeds=[SimpleNamespace(title=title, description=description)],
+        mentions=[SimpleNamespace(id=BOT_USER_ID)]
+    )
+
+
+def unclaimed(correlator: InteractionCorrelator) -> dict:
+    return correlator._InteractionCorrelator__unclaimed
+
+
+def test_reply_before_wait():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        message = reply('Waiting to start', interaction_id=5, nonce='n5')
+        assert not correlator.feed(message)
+        assert await correlator.wait(interaction(5, 'n5'), 'Waiting to start', timeout=1) is message
+        # buffered under both keys, claimed under both
+        assert not unclaimed(correlator)
+
+    asyncio.run(run())
+
+
+def test_reply_after_wait():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        message = reply('Generating', interaction_id=6, nonce='n6')
+        waiting = asyncio.create_task(correlator.wait(interaction(6, 'n6'), 'Generating', timeout=1))
+        await asyncio.sleep(0)
+        assert correlator.feed(message)
+        assert await waiting is message
+
+    asyncio.run(run())
+
+
+def test_concurrent_waiters_get_their_own_reply():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        first = asyncio.create_task(correlator.wait(interaction(1), 'Waiting to start', timeout=1))
+        second = asyncio.create_task(correlator.wait(interaction(2), 'Waiting to start', timeout=1))
+        await asyncio.sleep(0)
+        second_reply = reply('Waiting to start', interaction_id=2)
+        first_reply = reply('Waiting to start', interaction_id=1)
+        correlator.feed(second_reply)
+        correlator.feed(first_reply)
+        assert await first is first_reply
+        assert await second is second_reply
+
+    asyncio.run(run())
+
+
+def test_keyed_reply_binds_without_keyword():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        message = reply('Unable to find a free slot, waiting to start…', interaction_id=7, nonce='n7')
+        correlator.feed(message)
+        assert await correlator.wait(interaction(7, 'n7'), 'Generating', timeout=1) is message
+        assert not unclaimed(correlator)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('before_wait', [True, False], ids=['before wait', 'after wait'])
+def test_error_reply_binds(before_wait):
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        message = reply('You have run out of credits.', interaction_id=9, nonce='n9', title='Error')
+        if before_wait:
+            assert not correlator.feed(message)
+        waiting = asyncio.create_task(correlator.wait(interaction(9, 'n9'), 'Waiting to start', timeout=1))
+        await asyncio.sleep(0)
+        if not before_wait:
+            assert correlator.feed(message)
+        assert await waiting is message
+        assert parse_error(message) == 'Error\nYou have run out of credits.'
+
+    asyncio.run(run())
+
+
+def test_fallback_needs_keyword():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        waiting = asyncio.create_task(correlator.wait(interaction(10), 'Waiting to start', timeout=0.05))
+        await asyncio.sleep(0)
+        assert not correlator.feed(reply('You have run out of credits.', title='Error'))
+        with pytest.raises(asyncio.TimeoutError):
+            await waiting
+
+    asyncio.run(run())
+
+
+def test_fallback_without_interaction_metadata():
+    async def run():
+        correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID)
+        waiting = asyncio.create_task(correlator.wait(interaction(8), 'Waiting to start', timeout=1))
+        await asyncio.sleep(0)
+        assert not correlator.feed(reply('Generating'))
+        message = reply('Waiting to start')
+        assert correlator.feed(message)
+        assert await waiting is message
+
+    asyncio.run(run())
+
+
+def test_unclaimed_buffer_is_bounded():
+    correlator = InteractionCorrelator(bot_user_id=BOT_USER_ID, unclaimed_buffer_size=4)
+    for i in range(1, 10):
+        correlator.feed(reply('Waiting to start', interaction_id=i, nonce=f'n{i}'))
+    assert list(unclaimed(correlator)) == ['id:8', 'nonce:n8', 'id:9', 'nonce:n9']
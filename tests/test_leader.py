@@ -0,0 +1,88 @@
+import asyncio
+
+from fakeredis.aioredis import FakeRedis
+
+from app.leader import LeaderElection
+
+
+def test_lease_is_renewed_while_the_gateway_starts():
+    async def run():
+        redis = FakeRedis()
+        events = []
+        started = asyncio.Event()
+
+        async def slow_start():
+            # longer than the lease
+            await asyncio.sleep(0.5)
+            events.append('elected')
+            started.set()
+
+        async def demoted():
+            events.append('demoted')
+
+        leader = LeaderElection(
+            redis=redis,
+            key='leader',
+            on_elected=slow_start,
+            on_demoted=demoted,
+            lease=0.2,
+            heartbeat_interval=0.05
+        )
+        other = LeaderElection(
+            redis=redis,
+            key='leader',
+            on_elected=slow_start,
+            on_demoted=demoted,
+            lease=0.2,
+            heartbeat_interval=0.05
+        )
+        leader.start()
+        await asyncio.sleep(0.01)
+        other.start()
+        await asyncio.wait_for(started.wait(), timeout=2)
+        assert leader.is_leader and not other.is_leader
+        assert await leader.get_leader_id() == leader.instance_id
+        await other.close()
+        await leader.close()
+        assert events == ['elected', 'demoted']
+        assert await leader.get_leader_id() is None
+
+    asyncio.run(run())
+
+
+def test_hung_renew_steps_down():
+    async def run():
+        redis = FakeRedis()
+        events = []
+
+        async def elected():
+            events.append('elected')
+
+        async def demoted():
+            events.append('demoted')
+
+        leader = LeaderElection(
+            redis=redis,
+            key='leader',
+            on_elected=elected,
+            on_demoted=demoted,
+            lease=0.2,
+            heartbeat_interval=0.05
+        )
+        leader.start()
+        await asyncio.sleep(0.1)
+        assert leader.is_leader
+
+        async def hang(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        leader._LeaderElection__renew = hang
+        for _ in range(100):
+            if len(events) >= 3:
+                break
+            await asyncio.sleep(0.02)
+        # stepped down, and elected again once the lease expired
+        assert events[:3] == ['elected', 'demoted', 'elected']
+        await leader.close()
+
+    asyncio.run(run())
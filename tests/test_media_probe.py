@@ -0,0 +1,100 @@
+import io
+import struct
+
+import pytest
+
+from app.media_probe import MediaInfo, MediaProbeError, probe
+
+
+def png(width: int, height: int) -> bytes:
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I4s', len(ihdr), b'IHDR') + ihdr + b'\0' * 4 + b'IDAT'
+
+
+def jpeg(width: int, height: int) -> bytes:
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0' + b'\0' * 9
+    # a standalone marker and fill bytes before the frame header
+    sof0 = b'\xff\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + app0 + b'\xff\xd0' + sof0 + b'\xff\xda' + b'\0' * 64
+
+
+def box(box_type: bytes, payload: bytes = b'') -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def mvhd(timescale: int, duration: int) -> bytes:
+    return box(b'mvhd', b'\0' * 4 + b'\0' * 8 + struct.pack('>II', timescale, duration) + b'\0' * 80)
+
+
+def tkhd(width: int, height: int) -> bytes:
+    return box(b'tkhd', b'\0' * 4 + b'\0' * 20 + b'\0' * 52 + struct.pack('>II', width << 16, height << 16))
+
+
+def mp4(width: int, height: int, seconds: int, moov_last: bool = False) -> bytes:
+    ftyp = box(b'ftyp', b'isom\0\0\0\0')
+    moov = box(b'moov', mvhd(1000, seconds * 1000) + box(b'trak', tkhd(0, 0)) + box(b'trak', tkhd(width, height)))
+    # media data the prober has to seek over, 64-bit box size
+    mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + 4096) + b'\0' * 4096
+    return ftyp + (mdat + moov if moov_last else moov + mdat)
+
+
+def ebml(element_id: int, payload: bytes, unknown_size: bool = False) -> bytes:
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    size = b'\x01\xff\xff\xff\xff\xff\xff\xff' if unknown_size else b'\x01' + len(payload).to_bytes(7, 'big')
+    return id_bytes + size + payload
+
+
+def webm(width: int, height: int, milliseconds: float) -> bytes:
+    header = ebml(0x1A45DFA3, ebml(0x4282, b'webm'))
+    info = ebml(0x1549A966, ebml(0x2AD7B1, (1000000).to_bytes(3, 'big')) + ebml(0x4489, struct.pack('>f', milliseconds)))
+    video = ebml(0xE0, ebml(0xB0, width.to_bytes(2, 'big')) + ebml(0xBA, height.to_bytes(2, 'big')))
+    tracks = ebml(0x1654AE6B, ebml(0xAE, ebml(0xD7, b'\x01') + video))
+    cluster = ebml(0x1F43B675, b'\0' * 256)
+    return header + ebml(0x18538067, info + tracks + cluster, unknown_size=True)
+
+
+def webm_segment(payload: bytes) -> bytes:
+    # an empty EBML header and a live recorded Segment of unknown size
+    return ebml(0x1A45DFA3, b'') + b'\x18\x53\x80\x67\xff' + payload
+
+
+@pytest.mark.parametrize('data, expected', [
+    (png(640, 480), MediaInfo(kind='image', format='png', width=640, height=480)),
+    (jpeg(1920, 1080), MediaInfo(kind='image', format='jpeg', width=1920, height=1080)),
+    (mp4(1280, 720, 5), MediaInfo(kind='video', format='mp4', width=1280, height=720, duration=5)),
+    (mp4(720, 1280, 12, moov_last=True), MediaInfo(kind='video', format='mp4', width=720, height=1280, duration=12)),
+    (webm(854, 480, 3500), MediaInfo(kind='video', format='webm', width=854, height=480, duration=3.5)),
+], ids=['png', 'jpeg', 'mp4', 'mp4 moov last', 'webm'])
+def test_probe(data, expected):
+    assert probe(io.BytesIO(data)) == expected
+
+
+def test_unknown_format():
+    assert probe(io.BytesIO(b'GIF89a' + b'\0' * 32)) is None
+    assert probe(io.BytesIO(b'')) is None
+
+
+@pytest.mark.parametrize('data', [
+    png(640, 480)[:20],
+    jpeg(640, 480)[:30],
+    b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IEND', 1, 1),
+    box(b'ftyp', b'isom') + struct.pack('>I4s', 4, b'moov'),
+    struct.pack('>I4sQ', 1, b'ftyp', 2 ** 64 - 1) + b'isom',
+    mp4(640, 480, 5, moov_last=True)[:-64],
+    webm_segment(b'\x2a\xd7\xb1\x01\xff\xff\xff\xff\xff\xff\xfe' + b'\0' * 8),
+    webm_segment(ebml(0x2AD7B1, b'\x01' * 9)),
+    webm_segment(ebml(0x4489, b'\0' * 3)),
+], ids=[
+    'truncated png',
+    'truncated jpeg',
+    'png without ihdr',
+    'invalid mp4 box size',
+    'mp4 box size beyond file',
+    'truncated mp4',
+    'webm element size beyond file',
+    'webm uint longer than 8 bytes',
+    'webm duration of invalid size',
+])
+def test_corrupt_media(data):
+    with pytest.raises(MediaProbeError):
+        probe(io.BytesIO(data))
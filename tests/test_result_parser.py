@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.result_parser import parse_error, parse_progress, parse_result
+from app.schema import TaskCommand
+from scripts.benchmark_result_parser import load_fixtures
+
+FIXTURES = {x.name: x for x in load_fixtures()}
+
+# fixture name -> command of the parsed result, None if it is no result
+EXPECTED_RESULTS = {
+    'gen result': TaskCommand.GEN,
+    'gen upscale result': TaskCommand.GEN,
+    'real result': TaskCommand.REAL,
+    'animate result': TaskCommand.ANIMATE,
+    'video result embed': TaskCommand.VIDEO,
+    'video result content': TaskCommand.VIDEO,
+    'move result content': TaskCommand.MOVE,
+    'gen progress': None,
+    'video queued': None,
+    'gen failed': None,
+    'video waiting for a slot': None,
+    'gen prompt with error words': None,
+    'move result failed-take url': TaskCommand.MOVE,
+    'error embed': None,
+    'unrelated': None,
+}
+ERROR_FIXTURES = {'gen failed', 'error embed'}
+
+
+def message(content: str = '', embeds=(), attachments=()) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=1,
+        content=content,
+        embeds=[SimpleNamespace(**x) for x in embeds],
+        attachments=list(attachments),
+        components=[]
+    )
+
+
+def test_every_fixture_has_expectations():
+    assert set(FIXTURES) == set(EXPECTED_RESULTS)
+
+
+@pytest.mark.parametrize('name', EXPECTED_RESULTS)
+def test_parse_result(name):
+    result = parse_result(FIXTURES[name])
+    expected = EXPECTED_RESULTS[name]
+    assert (result.command if result else None) == expected
+    if expected is not None:
+        assets = result.images or result.videos
+        assert len(assets) == 1 and assets[0].url.startswith('https://')
+
+
+@pytest.mark.parametrize('name', EXPECTED_RESULTS)
+def test_parse_error(name):
+    error = parse_error(FIXTURES[name])
+    if name in ERROR_FIXTURES:
+        assert error
+    else:
+        assert error is None
+
+
+def test_gen_buttons():
+    result = parse_result(FIXTURES['gen result'])
+    assert list(result.upscale_custom_ids) == ['U1', 'U2', 'U3', 'U4']
+    assert list(result.vary_custom_ids) == ['V1', 'V2', 'V3', 'V4']
+    result = parse_result(FIXTURES['gen upscale result'])
+    assert result.upscale_custom_ids == {}
+    assert result.vary_custom_ids == {'V1': 'domoai::vary::1::9a8b7c6d'}
+
+
+def test_move_result_url():
+    result = parse_result(FIXTURES['move result failed-take url'])
+    assert result.videos[0].url == 'https://cdn.discordapp.com/attachments/1/2/failed-take.mp4'
+
+
+def test_parse_progress():
+    progress = parse_progress(FIXTURES['gen progress'])
+    assert progress.command == TaskCommand.GEN
+    assert progress.progress_percent == 45
+    assert progress.started
+    progress = parse_progress(FIXTURES['video queued'])
+    assert progress.queue_position == 3
+    assert progress.progress_percent is None
+    assert not progress.started
+    assert parse_progress(FIXTURES['gen result']) is None
+    assert parse_progress(FIXTURES['unrelated']) is None
+
+
+@pytest.mark.parametrize('msg', [
+    message(content='<@1>\nResult: https://cdn.discordapp.com/attachments/1/2/failed-take.mp4'),
+    message(content='error: invalid prompt, unable to generate'),
+    message(embeds=[dict(title='/video', description='Unable to find a free slot, waiting to start…')]),
+    message(embeds=[dict(title='/gen nsfw error art, invalid', description='Generating (10%)')]),
+    message(embeds=[dict(title='/animate', description='Waiting to start, 2 jobs failed before yours')]),
+    message(embeds=[dict(title='Tips', description='Prompts that violate our policy are rejected')]),
+])
+def test_parse_error_false_positives(msg):
+    assert parse_error(msg) is None
+
+
+@pytest.mark.parametrize('msg', [
+    message(embeds=[dict(title='/video', description='Generation failed: timeout')]),
+    message(embeds=[dict(title='Job failed', description='Please retry')]),
+])
+def test_parse_error_error_embeds(msg):
+    assert parse_error(msg)
@@ -0,0 +1,130 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import discord
+import pytest
+from discord import InvalidData
+
+from app.cache import MemoryCache
+from app.schema import Mode, TaskCacheData, TaskCommand, TaskStatus
+from app.user_client import DiscordUserClient
+from scripts.benchmark_result_parser import load_fixtures
+
+FIXTURES = {x.name: x for x in load_fixtures()}
+
+
+class FakeChannel:
+    def __init__(self):
+        self.uploads = 0
+
+    async def upload_files(self, *files):
+        self.uploads += 1
+        return [SimpleNamespace(name=f'upload-{self.uploads}')]
+
+
+class FakeCommand:
+    name = 'real'
+
+    def __init__(self, *outcomes):
+        # per call an interaction to return or an exception to raise
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    async def __call__(self, channel, **options):
+        self.calls.append(options)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+def http_exception() -> discord.HTTPException:
+    return discord.HTTPException(SimpleNamespace(status=400, reason='Bad Request'), 'Unknown attachment')
+
+
+async def invoke_reusing_upload(command: FakeCommand):
+    client = DiscordUserClient(channel_id=2, guild_id=1, application_id=3, cache=MemoryCache(), event_callback=None)
+    client.channel = FakeChannel()
+    client.commands['real'] = command
+    # a first command uploads the image, the second one reuses it
+    await client.real(image=discord.File(io.BytesIO(b'image'), filename='a.png'))
+    command.calls.clear()
+    try:
+        return await client.real(image=discord.File(io.BytesIO(b'image'), filename='a.png'))
+    finally:
+        await client.close()
+
+
+@pytest.mark.parametrize('failure', [
+    http_exception(),
+    SimpleNamespace(id=2, successful=False),
+], ids=['http exception', 'not successful'])
+def test_rejected_reused_upload_is_retried_fresh(failure):
+    async def run():
+        succeeded = SimpleNamespace(id=1, successful=True)
+        command = FakeCommand(succeeded, failure, succeeded)
+        assert await invoke_reusing_upload(command) is succeeded
+        first, retry = command.calls
+        assert first['image'].name == 'upload-1'
+        assert retry['image'].name == 'upload-2'
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('failure', [
+    InvalidData('Did not receive a response from Discord'),
+    asyncio.TimeoutError(),
+], ids=['no response', 'timeout'])
+def test_maybe_submitted_command_is_not_retried(failure):
+    async def run():
+        command = FakeCommand(SimpleNamespace(id=1, successful=True), failure)
+        with pytest.raises(type(failure)):
+            await invoke_reusing_upload(command)
+        assert len(command.calls) == 1
+
+    asyncio.run(run())
+
+
+class CountingCache(MemoryCache):
+    def __init__(self):
+        super().__init__()
+        self.task_reads = 0
+
+    async def get_task_data_by_id(self, task_id: str, refresh_ttl: bool = False):
+        self.task_reads += 1
+        return await super().get_task_data_by_id(task_id=task_id, refresh_ttl=refresh_ttl)
+
+
+def test_result_of_bound_task_is_saved_without_reading_the_record():
+    async def run():
+        cache = CountingCache()
+        event_callback = SimpleNamespace(send_task_success=lambda **kwargs: asyncio.sleep(0))
+        client = DiscordUserClient(
+            channel_id=2,
+            guild_id=1,
+            application_id=3,
+            cache=cache,
+            event_callback=event_callback
+        )
+        message = FIXTURES['gen result']
+        message.channel = SimpleNamespace(id=2)
+        message.guild = SimpleNamespace(id=1)
+        bound = TaskCacheData(
+            command=TaskCommand.GEN,
+            status=TaskStatus.RUNNING,
+            message_id=str(message.id),
+            created_at=1700000000.0,
+            submitted_at=1700000001.0,
+            mode=Mode.FAST
+        )
+        client.bind_task(message_id=str(message.id), task_id='t1', data=bound)
+        await client.handle_result(message=message)
+        assert cache.task_reads == 0
+        data = await cache.get_task_data_by_id(task_id='t1')
+        assert data.status == TaskStatus.SUCCESS
+        assert (data.created_at, data.submitted_at, data.mode) == (1700000000.0, 1700000001.0, Mode.FAST)
+        assert not client.in_flight_tasks and not client.in_flight_records
+        await client.close()
+
+    asyncio.run(run())